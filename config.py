@@ -1,6 +1,5 @@
 import logging
 import os
-import lib.utilities as utilities
 
 ########################################################################
 #
@@ -17,6 +16,7 @@ listening_port = 8081
 # Cost Estimate
 kwh_rate = 0.18  # Rate in currency_type to calculate cost to run job
 currency_type = "$"   # Currency Symbol to show when calculating cost to run job
+element_power = 5450.0  # W, power of the heating elements to estimate the energy used
 
 ########################################################################
 #
@@ -31,6 +31,12 @@ currency_type = "$"   # Currency Symbol to show when calculating cost to run job
 gpio_heat = 23  # Switches zero-cross solid-state-relay
 heater_invert = 0  # Switches the polarity of the heater control
 
+### How the heater output turns the pid duty into relay switching:
+#   time_proportioning - on for duty * sensor_time_wait, then off
+#   burst - fire whole mains half-cycles spread over sensor_time_wait
+heater_mode = "time_proportioning"
+mains_frequency = 60  # Hz, only used for burst firing
+
 ### Thermocouple Adapter selection:
 #   max31855 - bitbang SPI interface
 #   max31855spi - kernel SPI interface
@@ -53,6 +59,14 @@ spi_sensor_chip_id = 0
 ### value is used.
 sensor_time_wait = 2
 
+### what the control loop does when it falls behind its schedule:
+#   skip - drop the missed cycles and realign to the next one
+#   catchup - run the missed cycles back to back
+control_loop_policy = "skip"
+# the timing of the control loop (late and skipped cycles, worst overrun and
+# jitter) is logged every this many seconds
+control_loop_stats_interval = 600
+
 ########################################################################
 #
 #   PID parameters
@@ -80,6 +94,11 @@ sim_R_o_nocool = 1.0  # K/W  thermal resistance oven -> environment
 sim_R_o_cool = 0.05  # K/W  " with cooling
 sim_R_ho_noair = 0.1  # K/W  thermal resistance heat element -> oven
 sim_R_ho_air = 0.05  # K/W  " with internal air circulation
+# kiln-fit-model.py fits the model to recorded firings and writes it here,
+# where it replaces the parameters above. Records are resampled every
+# system_id_time_step seconds for the fit
+thermal_model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage", "model", "thermal_model.json")
+system_id_time_step = 30
 
 ########################################################################
 #
@@ -109,6 +128,64 @@ warning_temp_high = 5
 # cheap thermocouple.  Invest in a better thermocouple.
 thermocouple_offset = 0
 
+########################################################################
+#
+#   Recording settings:
+
+# maximum number of samples kept in memory for a firing. Beyond this the
+# oldest samples are thinned out, 100000 samples take about 4 MB and last
+# more than two days at full resolution. None keeps everything.
+telemetry_capacity = 100000
+
+# number of samples sent to a client that connects during a firing, clients
+# can ask for a different number up to status_backlog_max_points.
+status_backlog_points = 500
+status_backlog_max_points = 5000
+# the number a client asks for is rounded up to one of these, so that a
+# few downsampled views serve every client
+status_backlog_levels = [250, 500, 1000, 2500, 5000]
+# number of different client point budgets kept up to date
+telemetry_max_subsets = 5
+
+# frames waiting to be sent to one client before the oldest is dropped, and
+# seconds a client can stay behind before it is disconnected
+status_queue_length = 20
+status_evict_after = 30
+# number of profile changes remembered to sync clients incrementally
+profile_history_length = 100
+# rows per chunk when streaming an export of a firing
+export_chunk_rows = 2048
+
+# journal of the firing in progress, written while firing so that it can
+# be resumed after a crash or a power outage. It is fsync'ed every
+# journal_fsync_interval seconds, longer intervals mean less SD card wear.
+journal_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage", "journal", "current.journal")
+journal_fsync_interval = 60
+# an interrupted firing is only offered for resuming if the power was out
+# for less than this many minutes
+journal_max_outage = 30
+# resume an interrupted firing automatically on startup
+journal_auto_resume = False
+# when resuming, the schedule holds until the kiln is within this many
+# degrees of the target
+resume_hold_tolerance = 10
+
+# the status frames carry a smoothed temperature and ramp rate (degrees per
+# hour), smoothed over ramp_smoothing_time seconds. The estimate restarts
+# after ramp_max_gap seconds without samples
+ramp_smoothing_time = 120
+ramp_max_gap = 60
+
+# while firing, the rest of the schedule is simulated with the thermal model
+# (the sim_* parameters) every forecast_interval seconds, in steps of
+# forecast_time_step seconds and for at most forecast_horizon hours, to
+# forecast the end of the firing, the peak and the segments where the kiln
+# lags more than forecast_lag_tolerance degrees behind the schedule
+forecast_interval = 60
+forecast_time_step = 10
+forecast_horizon = 48
+forecast_lag_tolerance = 20
+
 ########################################################################
 #
 #   Analysis settings:
@@ -119,6 +196,17 @@ smoothing_scale = 1./60.
 unload_temperature = 122.  # F for 50 C
 # zoom around peak for plots:
 peak_zoom = 300.
+# rendered plots of the firings are cached here, at most plot_cache_files
+plot_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage", "plots")
+plot_cache_files = 200
+# processes that run the analysis and reports of finished firings
+report_workers = 1
+# finished report jobs remembered for /api/jobs
+report_jobs_kept = 20
+# the analysis libraries are only imported when they are needed, these
+# modules are imported in the background once the kiln is under control
+warm_up_modules = ["numpy"]
+warm_up_worker_modules = ["lib.analysis"]
 
 ########################################################################
 #
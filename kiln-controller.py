@@ -11,6 +11,7 @@ import geventwebsocket
 #from bottle import post, get
 from gevent.pywsgi import WSGIServer
 from geventwebsocket.handler import WebSocketHandler
+from geventwebsocket import WebSocketError
 
 
 try:
@@ -32,9 +33,19 @@ profile_path = os.path.join(script_dir, "storage", "profiles")
 
 from oven import Oven, Profile
 from ovenWatcher import OvenWatcher
+from journal import FiringJournal
+from profileStore import ProfileStore
+from broadcast import BroadcastHub, Frame
+from lib.export import export
 
 app = bottle.Bottle()
-oven = Oven()
+# a firing that was interrupted by a crash or a power outage can be resumed
+interrupted = FiringJournal.find_interrupted()
+oven = Oven(journal=FiringJournal())
+profiles = ProfileStore(profile_path, Profile)
+# clients of /storage are told about every change of the profiles
+storage_observers = BroadcastHub()
+profiles.listener = lambda delta: storage_observers.broadcast(delta, Frame.OTHER)
 ovenWatcher = OvenWatcher(oven)
 
 @app.route('/')
@@ -43,6 +54,7 @@ def index():
 
 @app.post('/api')
 def handle_api():
+    global interrupted
     log.info("/api is alive")
     log.info(bottle.request.json)
 
@@ -58,36 +70,72 @@ def handle_api():
             startat = bottle.request.json['startat']
 
         # get the wanted profile/kiln schedule
-        profile = find_profile(wanted)
+        profile = profiles.get_profile(wanted)
         if profile is None:
             return { "success" : False, "error" : "profile %s not found" % wanted }
-
-        # FIXME juggling of json should happen in the Profile class
-        profile_json = json.dumps(profile)
-        profile = Profile(profile_json)
+        # a new firing, the interrupted one can no longer be resumed
+        interrupted = None
         oven.run_profile(profile,startat=startat)
         ovenWatcher.record(profile)
 
+    # resume the firing interrupted by a power outage, holding until the
+    # kiln is back at the temperature of the schedule
+    if bottle.request.json['cmd'] == 'resume':
+        if interrupted is None:
+            return { "success" : False, "error" : "no interrupted firing to resume" }
+        if oven.state != Oven.STATE_IDLE:
+            return { "success" : False, "error" : "the oven is %s, stop it before resuming" % oven.state }
+        resume_firing()
+
     if bottle.request.json['cmd'] == 'stop':
         log.info("api stop command received")
         oven.abort_run()
 
     return { "success" : True }
 
-def find_profile(wanted):
+def export_response(source, name, profile=None, started=None):
     '''
-    given a wanted profile name, find it and return the parsed
-    json profile object or None.
+    stream a firing, the query parameters are format (csv or kiln), start
+    and end (runtime in seconds) and maxpts to downsample
     '''
-    #load all profiles from disk
-    profiles = get_profiles()
-    json_profiles = json.loads(profiles)
+    query = bottle.request.query
+    try:
+        content_type, extension, chunks = export(
+            source,
+            format=query.get('format', 'csv'),
+            start=float(query['start']) if 'start' in query else None,
+            end=float(query['end']) if 'end' in query else None,
+            maxpts=int(query['maxpts']) if 'maxpts' in query else None,
+            profile=profile,
+            started=started)
+    except ValueError as ex:
+        return { "success" : False, "error" : str(ex) }
+    bottle.response.content_type = content_type
+    bottle.response.set_header('Content-Disposition', 'attachment; filename="%s%s"' % (name, extension))
+    return chunks
+
+
+@app.route('/api/export')
+def handle_export():
+    '''export the current or last firing'''
+    profile = None
+    if ovenWatcher.last_profile is not None:
+        profile = {'name': ovenWatcher.last_profile.name, 'data': ovenWatcher.last_profile.data, 'type': "profile"}
+    started = ovenWatcher.started
+    name = started.strftime('%Y_%m_%d-%H_%M') if started is not None else "firing"
+    return export_response(ovenWatcher.last_log, name, profile, started)
+
+
+def resume_firing():
+    '''resume the interrupted firing found in the journal at startup'''
+    global interrupted
+    profile = Profile.from_dict(interrupted['profile'])
+    log.info("resuming %s at minute %.1f" % (profile.name, interrupted['startat']))
+    oven.run_profile(profile, startat=interrupted['startat'], hold=True)
+    oven.energy.restore(interrupted['samples'])
+    ovenWatcher.record(profile, samples=interrupted['samples'], started=interrupted['started'])
+    interrupted = None
 
-    # find the wanted profile
-    for profile in json_profiles:
-        if profile['name'] == wanted:
-            return profile
-    return None
 
 @app.route('/picoreflow/:filename#.*#')
 def send_static(filename):
@@ -105,6 +153,7 @@ def get_websocket_from_request():
 
 @app.route('/control')
 def handle_control():
+    global interrupted
     wsock = get_websocket_from_request()
     log.info("websocket (control) opened")
     while True:
@@ -116,8 +165,8 @@ def handle_control():
                 log.info("RUN command received")
                 profile_obj = msgdict.get('profile')
                 if profile_obj:
-                    profile_json = json.dumps(profile_obj)
-                    profile = Profile(profile_json)
+                    profile = Profile.from_dict(profile_obj)
+                interrupted = None
                 oven.run_profile(profile)
                 ovenWatcher.record(profile)
             elif msgdict.get("cmd") == "SIMULATE":
@@ -142,6 +191,9 @@ def handle_control():
 @app.route('/storage')
 def handle_storage():
     wsock = get_websocket_from_request()
+    # everything is sent through the channel, which also carries the
+    # profile changes made by the other clients
+    channel = storage_observers.add(wsock)
     log.info("websocket (storage) opened")
     while True:
         try:
@@ -157,14 +209,17 @@ def handle_storage():
 
             if message == "GET":
                 log.info("GET command received")
-                wsock.send(get_profiles())
+                channel.put(Frame(profiles.list_json()))
+            elif msgdict.get("cmd") == "GET":
+                # clients send the version they have and only get what changed
+                log.info("GET command received, version %s" % msgdict.get("version"))
+                channel.put(Frame(profiles.sync_json(msgdict.get("version"))))
             elif msgdict.get("cmd") == "DELETE":
                 log.info("DELETE command received")
                 profile_obj = msgdict.get('profile')
-                if delete_profile(profile_obj):
-                  msgdict["resp"] = "OK"
-                wsock.send(json.dumps(msgdict))
-                #wsock.send(get_profiles())
+                if profiles.delete(profile_obj):
+                    msgdict["resp"] = "OK"
+                channel.put(Frame(msgdict))
             elif msgdict.get("cmd") == "PUT":
                 log.info("PUT command received")
                 profile_obj = msgdict.get('profile')
@@ -172,16 +227,15 @@ def handle_storage():
                 force = True
                 if profile_obj:
                     #del msgdict["cmd"]
-                    if save_profile(profile_obj, force):
+                    if profiles.save(profile_obj, force):
                         msgdict["resp"] = "OK"
                     else:
                         msgdict["resp"] = "FAIL"
                     log.debug("websocket (storage) sent: %s" % message)
-
-                    wsock.send(json.dumps(msgdict))
-                    wsock.send(get_profiles())
+                    channel.put(Frame(msgdict))
         except WebSocketError:
             break
+    storage_observers.remove(wsock)
     log.info("websocket (storage) closed")
 
 
@@ -198,10 +252,28 @@ def handle_config():
     log.info("websocket (config) closed")
 
 
+def query_int(query, name, default=None):
+    '''an integer query parameter, default when it is missing or malformed'''
+    try:
+        return int(float(query[name])) if name in query else default
+    except (ValueError, OverflowError):
+        return default
+
+
 @app.route('/status')
 def handle_status():
     wsock = get_websocket_from_request()
-    ovenWatcher.add_observer(wsock)
+    # clients can ask for the number of backlog points: /status?maxpts=1000
+    # and resume after a reconnect: /status?since=1234&epoch=0a1b2c3d
+    # format=compact selects the compact wire format
+    query = bottle.request.query
+    maxpts = query_int(query, 'maxpts', config.status_backlog_points)
+    since = query_int(query, 'since')
+    ovenWatcher.add_observer(wsock,
+                             maxpts=maxpts,
+                             since=since,
+                             epoch=query.get('epoch'),
+                             format=query.get('format'))
     log.info("websocket (status) opened")
     while True:
         try:
@@ -209,43 +281,10 @@ def handle_status():
             wsock.send("Your message was: %r" % message)
         except WebSocketError:
             break
+    ovenWatcher.remove_observer(wsock)
     log.info("websocket (status) closed")
 
 
-def get_profiles():
-    try:
-        profile_files = os.listdir(profile_path)
-    except:
-        profile_files = []
-    profiles = []
-    for filename in profile_files:
-        with open(os.path.join(profile_path, filename), 'r') as f:
-            profiles.append(json.load(f))
-    return json.dumps(profiles)
-
-
-def save_profile(profile, force=False):
-    profile_json = json.dumps(profile)
-    filename = profile['name']+".json"
-    filepath = os.path.join(profile_path, filename)
-    if not force and os.path.exists(filepath):
-        log.error("Could not write, %s already exists" % filepath)
-        return False
-    with open(filepath, 'w+') as f:
-        f.write(profile_json)
-        f.close()
-    log.info("Wrote %s" % filepath)
-    return True
-
-def delete_profile(profile):
-    profile_json = json.dumps(profile)
-    filename = profile['name']+".json"
-    filepath = os.path.join(profile_path, filename)
-    os.remove(filepath)
-    log.info("Deleted %s" % filepath)
-    return True
-
-
 def get_config():
     return json.dumps({"temp_scale": config.temp_scale,
         "time_scale_slope": config.time_scale_slope,
@@ -255,6 +294,14 @@ def get_config():
 
 
 def main():
+    if interrupted is not None:
+        log.warning("firing of %s was interrupted %d minutes ago at minute %.1f" %
+                    (interrupted['profile']['name'], interrupted['outage'] / 60, interrupted['startat']))
+        if config.journal_auto_resume:
+            resume_firing()
+        else:
+            log.warning("send the resume command to /api to resume it")
+
     ip = config.listening_ip
     port = config.listening_port
     log.info("listening on %s:%d" % (ip, port))
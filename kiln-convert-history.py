@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Convert pickled firing records to the columnar history format.
+
+    ./kiln-convert-history.py storage/history/*.pickle
+
+Unpickling runs code from the file, only convert records made by your kiln.
+"""
+
+import os
+import sys
+import logging
+
+try:
+    sys.dont_write_bytecode = True
+    import config
+    sys.dont_write_bytecode = False
+except:
+    print("Could not import config file.")
+    print("Copy config.py.EXAMPLE to config.py and adapt it for your setup.")
+    exit(1)
+
+logging.basicConfig(level=config.log_level, format=config.log_format)
+log = logging.getLogger("kiln-convert-history")
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, script_dir + '/lib/')
+
+from lib.history import convert_pickle, HistoryRecord
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: %s record.pickle [record.pickle ...]" % sys.argv[0])
+        exit(1)
+    for filename in sys.argv[1:]:
+        out_name = convert_pickle(filename)
+        record = HistoryRecord(out_name)
+        print("%s: %d samples -> %s" % (filename, len(record), out_name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Fit the thermal model of the simulator and of the forecasts to firings of
+the history.
+
+    ./kiln-fit-model.py                      # every firing in storage/history
+    ./kiln-fit-model.py 2021_01_01-23_02 2021_02_11-08_30
+
+The model is written to config.thermal_model_path, where the simulated oven
+and the forecasts load it instead of the sim_* parameters of config.py.
+"""
+
+import os
+import sys
+import logging
+
+try:
+    sys.dont_write_bytecode = True
+    import config
+    sys.dont_write_bytecode = False
+except:
+    print("Could not import config file.")
+    print("Copy config.py.EXAMPLE to config.py and adapt it for your setup.")
+    exit(1)
+
+logging.basicConfig(level=config.log_level, format=config.log_format)
+log = logging.getLogger("kiln-fit-model")
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, script_dir + '/lib/')
+history_path = os.path.join(script_dir, "storage", "history")
+
+from lib.systemId import fit_history, FITTED
+
+
+def main():
+    try:
+        model = fit_history(history_path, sys.argv[1:])
+    except (ValueError, OSError) as ex:
+        print(ex)
+        exit(1)
+    report = model['fit']
+    for run in report['runs']:
+        print("%s: rms residual %.1f, max %.1f" % (run['name'], run['rms'], run['max']))
+    print("%d samples, rms residual %.1f degrees, %d model runs in %.1f s" %
+          (report['samples'], report['rms'], report['evaluations'], report['seconds']))
+    for name in FITTED:
+        print("%s = %g" % (name, model[name]))
+    print("written to %s" % config.thermal_model_path)
+
+
+if __name__ == "__main__":
+    main()
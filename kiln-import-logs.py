@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Import the firings logged in daemon.log into the history.
+
+    ./kiln-import-logs.py /var/log/daemon.log*
+
+Rotated and gzipped logs are read oldest first, firings that were already
+imported are skipped.
+"""
+
+import os
+import sys
+import time
+import logging
+
+try:
+    sys.dont_write_bytecode = True
+    import config
+    sys.dont_write_bytecode = False
+except:
+    print("Could not import config file.")
+    print("Copy config.py.EXAMPLE to config.py and adapt it for your setup.")
+    exit(1)
+
+logging.basicConfig(level=config.log_level, format=config.log_format)
+log = logging.getLogger("kiln-import-logs")
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, script_dir + '/lib/')
+profile_path = os.path.join(script_dir, "storage", "profiles")
+history_path = os.path.join(script_dir, "storage", "history")
+
+from oven import Profile
+from profileStore import ProfileStore
+from lib.logImport import import_logs
+from lib.catalog import HistoryCatalog
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: %s daemon.log [daemon.log.1 daemon.log.2.gz ...]" % sys.argv[0])
+        exit(1)
+    size = sum(os.path.getsize(path) for path in sys.argv[1:])
+    t0 = time.perf_counter()
+    written = import_logs(sys.argv[1:], history_path, profiles=ProfileStore(profile_path, Profile).list())
+    elapsed = time.perf_counter() - t0
+    print("%d firings imported from %.1f MB in %.1f s" % (len(written), size / 1e6, elapsed))
+    catalog = HistoryCatalog(history_path)
+    catalog.refresh()
+    for name in written:
+        summary = catalog.entries.get(os.path.basename(name))
+        if summary is not None:
+            print("%s: %s, %.1f hours, peak %.1f" % (summary['file'], summary['profile'],
+                                                     summary['duration'], summary['max_t'] or 0.))
+
+
+if __name__ == "__main__":
+    main()
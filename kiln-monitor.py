@@ -44,14 +44,37 @@ history_path = os.path.join(script_dir, "storage", "history")
 
 from lib.oven import Oven, Profile
 from lib.ovenMonitor import OvenMonitor
-import lib.utilities as utilities
+from lib.journal import FiringJournal
+from lib.profileStore import ProfileStore
+from lib.broadcast import BroadcastHub, Frame
+from lib.catalog import HistoryCatalog
+from lib.export import export
+import lib.history as history
+import lib.plots as plots
+from lib.reportWorker import ReportWorker, warm_up
+
+# the report worker forks, start it before anything starts a thread:
+reports = ReportWorker()
+reports.start()
 
 app = bottle.Bottle()
-oven = Oven()
+# a firing that was interrupted by a crash or a power outage can be resumed
+interrupted = FiringJournal.find_interrupted()
+oven = Oven(journal=FiringJournal())
+profiles = ProfileStore(profile_path, Profile)
+# clients of /storage are told about every change of the profiles
+storage_observers = BroadcastHub()
+profiles.listener = lambda delta: storage_observers.broadcast(delta, Frame.OTHER)
+catalog = HistoryCatalog(history_path)
 
 # prepare settings and start monitor:
 analysis_settings = {'smoothing_scale': config.smoothing_scale}
 ovenMonitor = OvenMonitor(oven, analysis_settings=analysis_settings)
+reports.listener = lambda job: ovenMonitor.notify_all(job, Frame.OTHER)
+
+# the kiln is under control, load the analysis libraries in the background:
+warm_up(config.warm_up_modules)
+reports.warm_up(config.warm_up_worker_modules)
 
 # spawn website:
 if has_ngrok:
@@ -77,6 +100,7 @@ def index():
 
 @app.post('/api')
 def handle_api():
+    global interrupted
     log.info("/api is alive")
     log.info(bottle.request.json)
 
@@ -92,16 +116,23 @@ def handle_api():
             startat = bottle.request.json['startat']
 
         # get the wanted profile/kiln schedule
-        profile = find_profile(wanted)
+        profile = profiles.get_profile(wanted)
         if profile is None:
             return { "success" : False, "error" : "profile %s not found" % wanted }
-
-        # FIXME juggling of json should happen in the Profile class
-        profile_json = json.dumps(profile)
-        profile = Profile(profile_json)
+        # a new firing, the interrupted one can no longer be resumed
+        interrupted = None
         oven.run_profile(profile, startat=startat)
         ovenMonitor.record(profile)
 
+    # resume the firing interrupted by a power outage, holding until the
+    # kiln is back at the temperature of the schedule
+    if bottle.request.json['cmd'] == 'resume':
+        if interrupted is None:
+            return { "success" : False, "error" : "no interrupted firing to resume" }
+        if oven.state != Oven.STATE_IDLE:
+            return { "success" : False, "error" : "the oven is %s, stop it before resuming" % oven.state }
+        resume_firing()
+
     if bottle.request.json['cmd'] == 'stop':
         log.info("api stop command received")
         oven.abort_run()
@@ -109,20 +140,131 @@ def handle_api():
     return {"success": True}
 
 
-def find_profile(wanted):
+@app.route('/api/plot/<run>/<kind>')
+def handle_plot(run, kind):
+    '''
+    plot of a firing of the history: kind is full, peak or ramp, the query
+    parameters are format (png, svg or pdf) and the analysis options
+    '''
+    query = bottle.request.query
+    format = query.get('format', 'png')
+    options = {name: query[name] for name in plots.OPTIONS if name in query}
+    try:
+        path = plots.cached_plot(history_path, config.plot_cache_path, run, kind, format, options)
+        if path is None:
+            # rendered in the report worker, meanwhile the server keeps going
+            path = reports.call("lib.plots:render_plot", history_path, config.plot_cache_path,
+                                run, kind, format, options)
+    except (ValueError, OSError, history.HistoryFormatError) as ex:
+        return {"success": False, "error": str(ex)}
+    return bottle.static_file(os.path.basename(path), root=config.plot_cache_path,
+                              mimetype=plots.FORMATS[format])
+
+
+@app.route('/api/jobs')
+def handle_jobs():
+    '''state of the analysis and report jobs'''
+    return {"success": True, "jobs": reports.get_jobs()}
+
+
+@app.get('/api/model')
+def handle_model():
+    '''the thermal model of the simulator and the forecasts'''
+    model = {"fit": None}
+    if os.path.isfile(config.thermal_model_path):
+        with open(config.thermal_model_path, 'r') as f:
+            model = json.load(f)
+    model.update(oven.get_model().parameters())
+    return {"success": True, "model": model}
+
+
+@app.post('/api/model')
+def handle_model_fit():
     '''
-    given a wanted profile name, find it and return the parsed
-    json profile object or None.
+    fit the thermal model to firings of the history, all of them unless
+    runs lists their names
     '''
-    # load all profiles from disk
-    profiles = get_profiles()
-    json_profiles = json.loads(profiles)
+    runs = (bottle.request.json or {}).get("runs")
+    try:
+        # fitted in the report worker, meanwhile the server keeps going
+        model = reports.call("lib.systemId:fit_history", history_path, runs, config.thermal_model_path)
+    except (ValueError, OSError) as ex:
+        return {"success": False, "error": str(ex)}
+    return {"success": True, "model": model}
+
 
-    # find the wanted profile
-    for profile in json_profiles:
-        if profile['name'] == wanted:
-            return profile
-    return None
+@app.route('/api/history')
+def handle_history():
+    '''
+    list past firings from the catalog, filtered with the query parameters
+    profile, since and until (ISO dates), min_peak and max_peak
+    '''
+    query = bottle.request.query
+    names = catalog.stale()
+    if names:
+        # new records are summarized in the report worker, meanwhile the server keeps going
+        catalog.update(reports.call("lib.catalog:summarize_files", history_path, names))
+    runs = catalog.query(profile=query.get('profile'),
+                         since=query.get('since'),
+                         until=query.get('until'),
+                         min_peak=query_float(query, 'min_peak'),
+                         max_peak=query_float(query, 'max_peak'))
+    return {"success": True, "runs": runs}
+
+
+def export_response(source, name, profile=None, started=None):
+    '''
+    stream a firing, the query parameters are format (csv or kiln), start
+    and end (runtime in seconds) and maxpts to downsample
+    '''
+    query = bottle.request.query
+    try:
+        content_type, extension, chunks = export(
+            source,
+            format=query.get('format', 'csv'),
+            start=float(query['start']) if 'start' in query else None,
+            end=float(query['end']) if 'end' in query else None,
+            maxpts=int(query['maxpts']) if 'maxpts' in query else None,
+            profile=profile,
+            started=started)
+    except ValueError as ex:
+        return {"success": False, "error": str(ex)}
+    bottle.response.content_type = content_type
+    bottle.response.set_header('Content-Disposition', 'attachment; filename="%s%s"' % (name, extension))
+    return chunks
+
+
+@app.route('/api/export')
+def handle_export():
+    '''export the current or last firing'''
+    profile = None
+    if ovenMonitor.last_profile is not None:
+        profile = {'name': ovenMonitor.last_profile.name, 'data': ovenMonitor.last_profile.data, 'type': "profile"}
+    started = ovenMonitor.started
+    name = started.strftime('%Y_%m_%d-%H_%M') if started is not None else "firing"
+    return export_response(ovenMonitor.last_log, name, profile, started)
+
+
+@app.route('/api/export/<filename>')
+def handle_export_record(filename):
+    '''export a firing of the history'''
+    name, extension = os.path.splitext(os.path.basename(filename))
+    path = os.path.join(history_path, name + history.EXTENSION)
+    if not os.path.isfile(path):
+        return {"success": False, "error": "firing %s not found" % name}
+    record = history.HistoryRecord(path)
+    return export_response(record, name, record.profile, record.started)
+
+
+def resume_firing():
+    '''resume the interrupted firing found in the journal at startup'''
+    global interrupted
+    profile = Profile.from_dict(interrupted['profile'])
+    log.info("resuming %s at minute %.1f" % (profile.name, interrupted['startat']))
+    oven.run_profile(profile, startat=interrupted['startat'], hold=True)
+    oven.energy.restore(interrupted['samples'])
+    ovenMonitor.record(profile, samples=interrupted['samples'], started=interrupted['started'])
+    interrupted = None
 
 
 @app.route('/picoreflow/:filename#.*#')
@@ -140,6 +282,7 @@ def get_websocket_from_request():
 
 @app.route('/control')
 def handle_control():
+    global interrupted
     wsock = get_websocket_from_request()
     log.info("websocket (control) opened")
     while True:
@@ -154,14 +297,18 @@ def handle_control():
                 emails = emails.replace(' ', '').split(',')
                 emails = list(filter(None, emails))
                 if profile_obj:
-                    profile_json = json.dumps(profile_obj)
-                    profile = Profile(profile_json)
+                    profile = Profile.from_dict(profile_obj)
+                interrupted = None
                 oven.run_profile(profile)
                 ovenMonitor.record(profile, emails)
                 if len(ovenMonitor.email_destination) > 0:
-                    ovenMonitor.send_email_start(config.sender_name,
-                                                 config.gmail_user,
-                                                 config.gmail_password)
+                    reports.submit("start email", "lib.analysis:send_email_start",
+                                   ovenMonitor.started,
+                                   ovenMonitor.tunnel_website,
+                                   list(ovenMonitor.email_destination),
+                                   config.sender_name,
+                                   config.gmail_user,
+                                   config.gmail_password)
             elif msgdict.get("cmd") == "SIMULATE":
                 log.info("SIMULATE command received")
                 #profile_obj = msgdict.get('profile')
@@ -176,14 +323,19 @@ def handle_control():
             elif msgdict.get("cmd") == "STOP":
                 log.info("Stop command received")
                 oven.abort_run()
-                # plot and send email:
+                # the record is written in a thread, only this greenlet waits:
+                record_path = gevent.get_hub().threadpool.apply(ovenMonitor.save_record_to_file, (history_path,))
+                # summarize it for the catalog, plot and send email in the report worker:
+                reports.submit("catalog", "lib.catalog:summarize_file", record_path, callback=catalog.put)
                 if len(ovenMonitor.email_destination) > 0:
-                    ovenMonitor.send_email_report(history_path,
-                                                  config.sender_name,
-                                                  config.gmail_user,
-                                                  config.gmail_password)
-                else:
-                    ovenMonitor.save_record_to_file(history_path)
+                    reports.submit("report", "lib.analysis:report_job",
+                                   record_path,
+                                   config.plot_cache_path,
+                                   ovenMonitor.analysis_settings,
+                                   list(ovenMonitor.email_destination),
+                                   config.sender_name,
+                                   config.gmail_user,
+                                   config.gmail_password)
 
         except WebSocketError as ex1:
             print('WebSocketError', ex1)
@@ -197,6 +349,9 @@ def handle_control():
 @app.route('/storage')
 def handle_storage():
     wsock = get_websocket_from_request()
+    # everything is sent through the channel, which also carries the
+    # profile changes made by the other clients
+    channel = storage_observers.add(wsock)
     log.info("websocket (storage) opened")
     while True:
         try:
@@ -212,14 +367,17 @@ def handle_storage():
 
             if message == "GET":
                 log.info("GET command received")
-                wsock.send(get_profiles())
+                channel.put(Frame(profiles.list_json()))
+            elif msgdict.get("cmd") == "GET":
+                # clients send the version they have and only get what changed
+                log.info("GET command received, version %s" % msgdict.get("version"))
+                channel.put(Frame(profiles.sync_json(msgdict.get("version"))))
             elif msgdict.get("cmd") == "DELETE":
                 log.info("DELETE command received")
                 profile_obj = msgdict.get('profile')
-                if delete_profile(profile_obj):
-                  msgdict["resp"] = "OK"
-                wsock.send(json.dumps(msgdict))
-                #wsock.send(get_profiles())
+                if profiles.delete(profile_obj):
+                    msgdict["resp"] = "OK"
+                channel.put(Frame(msgdict))
             elif msgdict.get("cmd") == "PUT":
                 log.info("PUT command received")
                 profile_obj = msgdict.get('profile')
@@ -227,16 +385,15 @@ def handle_storage():
                 force = True
                 if profile_obj:
                     #del msgdict["cmd"]
-                    if save_profile(profile_obj, force):
+                    if profiles.save(profile_obj, force):
                         msgdict["resp"] = "OK"
                     else:
                         msgdict["resp"] = "FAIL"
                     log.debug("websocket (storage) sent: %s" % message)
-
-                    wsock.send(json.dumps(msgdict))
-                    wsock.send(get_profiles())
+                    channel.put(Frame(msgdict))
         except WebSocketError:
             break
+    storage_observers.remove(wsock)
     log.info("websocket (storage) closed")
 
 
@@ -253,10 +410,36 @@ def handle_config():
     log.info("websocket (config) closed")
 
 
+def query_int(query, name, default=None):
+    '''an integer query parameter, default when it is missing or malformed'''
+    try:
+        return int(float(query[name])) if name in query else default
+    except (ValueError, OverflowError):
+        return default
+
+
+def query_float(query, name, default=None):
+    '''a number query parameter, default when it is missing or malformed'''
+    try:
+        return float(query[name]) if name in query else default
+    except ValueError:
+        return default
+
+
 @app.route('/status')
 def handle_status():
     wsock = get_websocket_from_request()
-    ovenMonitor.add_observer(wsock)
+    # clients can ask for the number of backlog points: /status?maxpts=1000
+    # and resume after a reconnect: /status?since=1234&epoch=0a1b2c3d
+    # format=compact selects the compact wire format
+    query = bottle.request.query
+    maxpts = query_int(query, 'maxpts', config.status_backlog_points)
+    since = query_int(query, 'since')
+    ovenMonitor.add_observer(wsock,
+                             maxpts=maxpts,
+                             since=since,
+                             epoch=query.get('epoch'),
+                             format=query.get('format'))
     log.info("websocket (status) opened")
     while True:
         try:
@@ -264,6 +447,7 @@ def handle_status():
             wsock.send("Your message was: %r" % message)
         except WebSocketError:
             break
+    ovenMonitor.remove_observer(wsock)
     log.info("websocket (status) closed")
 
 
@@ -271,41 +455,6 @@ def handle_status():
 # Profile handling:
 
 
-def get_profiles():
-    try:
-        profile_files = os.listdir(profile_path)
-    except:
-        profile_files = []
-    profiles = []
-    for filename in profile_files:
-        with open(os.path.join(profile_path, filename), 'r') as f:
-            profiles.append(json.load(f))
-    return json.dumps(profiles)
-
-
-def save_profile(profile, force=False):
-    profile_json = json.dumps(profile)
-    filename = profile['name']+".json"
-    filepath = os.path.join(profile_path, filename)
-    if not force and os.path.exists(filepath):
-        log.error("Could not write, %s already exists" % filepath)
-        return False
-    with open(filepath, 'w+') as f:
-        f.write(profile_json)
-        f.close()
-    log.info("Wrote %s" % filepath)
-    return True
-
-
-def delete_profile(profile):
-    profile_json = json.dumps(profile)
-    filename = profile['name']+".json"
-    filepath = os.path.join(profile_path, filename)
-    os.remove(filepath)
-    log.info("Deleted %s" % filepath)
-    return True
-
-
 def get_config():
     return json.dumps({"temp_scale": config.temp_scale,
                        "time_scale_slope": config.time_scale_slope,
@@ -318,6 +467,14 @@ def get_config():
 
 
 def main():
+    if interrupted is not None:
+        log.warning("firing of %s was interrupted %d minutes ago at minute %.1f" %
+                    (interrupted['profile']['name'], interrupted['outage'] / 60, interrupted['startat']))
+        if config.journal_auto_resume:
+            resume_firing()
+        else:
+            log.warning("send the resume command to /api to resume it")
+
     ip = config.listening_ip
     port = config.listening_port
     log.info("listening on %s:%d" % (ip, port))
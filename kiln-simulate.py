@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Simulate kiln schedules as fast as possible, without a kiln.
+
+    ./kiln-simulate.py storage/profiles/cone-6-long-glaze.json
+"""
+
+import os
+import sys
+import time
+import logging
+
+try:
+    sys.dont_write_bytecode = True
+    import config
+    sys.dont_write_bytecode = False
+except:
+    print("Could not import config file.")
+    print("Copy config.py.EXAMPLE to config.py and adapt it for your setup.")
+    exit(1)
+
+logging.basicConfig(level=logging.WARNING, format=config.log_format)
+log = logging.getLogger("kiln-simulate")
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, script_dir + '/lib/')
+
+import numpy as np
+
+from oven import Profile
+from simulation import simulate_profile
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: %s profile.json [profile.json ...]" % sys.argv[0])
+        exit(1)
+    for filename in sys.argv[1:]:
+        with open(filename, 'r') as f:
+            profile = Profile(f.read())
+        t0 = time.perf_counter()
+        trace = simulate_profile(profile)
+        elapsed = time.perf_counter() - t0
+        error = trace['temperature'] - trace['target']
+        print("%s: %.1f hours simulated in %.3f s, peak=%.1f, rms error=%.2f" %
+              (profile.name, profile.get_duration() / 3600., elapsed,
+               np.amax(trace['temperature']), np.sqrt(np.mean(error**2))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+Analysis and reports of finished firings.
+
+The functions of this module only take and return plain data, so that
+they can run in the report worker process, see reportWorker.py.
+"""
+import os
+import logging
+
+# data analysis libraries:
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.ticker import AutoMinorLocator, MaxNLocator
+from . import utilities as utilities
+from .history import HistoryRecord
+
+# email imports:
+import smtplib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+
+log = logging.getLogger(__name__)
+
+
+def prepare(time, temperature, analysis_settings={}):
+    """
+    Smooth the data of a fire, compute its ramp rate and the report.
+    time is the runtime in seconds. Returns the data of the plots.
+    """
+    # get analysis options:
+    smoothing_scale = analysis_settings.get('smoothing_scale', 1./60.)
+    unload_temperature = analysis_settings.get('unload_temperature', 122.)
+
+    # get the data:
+    time = np.asarray(time, dtype=float)
+    time = (time - time[0]) / 3600.
+    temperature = np.asarray(temperature, dtype=float)
+
+    # interpolate data and get data on equispaced grid:
+    equi_time = np.linspace(time[0], time[-1], len(time))
+    equi_temp = np.interp(equi_time, time, temperature)
+
+    # smooth the data and get its derivative with reflective boundaries to avoid artefacts:
+    smooth_temp, temperature_der = utilities.smooth_gaussian(equi_time, equi_temp, smoothing_scale,
+                                                             mode='reflect', derivative=True)
+
+    # now cut the data to highlight the fire regime:
+    filter = temperature > unload_temperature
+    if np.all(np.logical_not(filter)):
+        ind_min, ind_max = 0, len(filter)-1
+    else:
+        ind_min, ind_max = np.where(filter)[0][0], np.where(filter)[0][-1]
+    temperature = temperature[ind_min:ind_max+1]
+    time = time[ind_min:ind_max+1]
+
+    filter = np.logical_and(time[0] <= equi_time, equi_time <= time[-1])
+    if np.all(np.logical_not(filter)):
+        ind_min, ind_max = 0, len(filter)-1
+    else:
+        ind_min, ind_max = np.where(filter)[0][0], np.where(filter)[0][-1]
+    smooth_temp = smooth_temp[ind_min:ind_max+1]
+    temperature_der = temperature_der[ind_min:ind_max+1]
+    equi_time = equi_time[ind_min:ind_max+1]
+
+    equi_time = equi_time - time[0]
+    time = time - time[0]
+
+    # fixed plot width per hour:
+    cm_to_inch = 2.54
+    plot_height = 10.  # in cm
+    cm_per_hour = plot_height/2.
+    plot_width = max(plot_height, cm_per_hour*time[-1])
+    plot_height, plot_width = plot_height/cm_to_inch, plot_width/cm_to_inch
+
+    ###############################################################
+    # prepare report:
+    report = {}
+    # maximum temperature:
+    report['max_t'] = np.amax(temperature)
+    report['max_t_smooth'] = np.amax(smooth_temp)
+    # fire duration:
+    report['fire_duration'] = utilities.fire_duration(time, temperature, unload_temperature)
+
+    return {'time': time, 'temperature': temperature,
+            'equi_time': equi_time, 'smooth_temp': smooth_temp, 'temperature_der': temperature_der,
+            'plot_width': plot_width, 'plot_height': plot_height, 'report': report}
+
+
+def _finalize(fig, ax, data, started, out_name, dpi):
+    # axis:
+    for _ax in ax:
+        _ax.xaxis.set_major_locator(MaxNLocator(nbins=max(5, int(np.amax(data['time']))), integer=True))
+        _ax.xaxis.set_minor_locator(AutoMinorLocator())
+        _ax.yaxis.set_minor_locator(AutoMinorLocator())
+        _ax.grid(which='major', lw=1., ls='--', zorder=0)
+        _ax.grid(which='minor', lw=.5, ls='--', zorder=0)
+    # finalize the plot:
+    if started is not None:
+        ax[0].set_title('Fire started '+started.strftime('%Y/%m/%d %H:%M'))
+    fig.tight_layout()
+    fig.savefig(out_name, dpi=dpi)
+    plt.close(fig)
+
+
+def plot_full(data, started, out_name, dpi=100):
+    """
+    Plot temperature and temperature derivative of the whole fire.
+    The format follows the extension of out_name.
+    """
+    time, temperature = data['time'], data['temperature']
+    equi_time, smooth_temp, temperature_der = data['equi_time'], data['smooth_temp'], data['temperature_der']
+    fig, ax = plt.subplots(nrows=2, sharex=True, figsize=(data['plot_width'], 2.*data['plot_height']))
+
+    # data:
+    ax[0].plot(time, temperature, ls='-', lw=1., zorder=999, label='temp')
+    ax[0].plot(equi_time, smooth_temp, ls='-', lw=1., zorder=999, label='avg temp')
+
+    ax[1].plot(equi_time, temperature_der, ls='-', lw=1., zorder=999)
+    ax[1].axhline(0., ls='--', lw=1., color='k')
+
+    # plot limits:
+    ax[0].set_xlim([np.amin(time), np.amax(time)])
+    ax[1].set_xlim([np.amin(equi_time), np.amax(equi_time)])
+
+    # labels:
+    ax[0].set_ylabel('temperature [F]')
+    ax[1].set_xlabel('time [hours]')
+    ax[1].set_ylabel('temperature ramp [F/hour]')
+
+    ax[0].legend()
+    _finalize(fig, ax, data, started, out_name, dpi)
+    return True
+
+
+def has_peak_zoom(data, peak_zoom=300.):
+    """
+    Whether part of the fire is more than peak_zoom degrees below the peak,
+    otherwise the peak plot is the same as the full plot.
+    """
+    return np.amin(data['temperature']) < data['report']['max_t'] - peak_zoom
+
+
+def plot_peak(data, started, out_name, peak_zoom=300., dpi=100, always=False):
+    """
+    Plot the fire within peak_zoom degrees of the peak, returns False
+    (and plots nothing) if the whole fire is that close to the peak,
+    unless always is set.
+    """
+    time, temperature = data['time'], data['temperature']
+    equi_time, smooth_temp, temperature_der = data['equi_time'], data['smooth_temp'], data['temperature_der']
+    if not has_peak_zoom(data, peak_zoom):
+        if not always:
+            return False
+        T_min = -np.inf
+    else:
+        T_min = data['report']['max_t'] - peak_zoom
+
+    fig, ax = plt.subplots(nrows=2, sharex=True, figsize=(data['plot_width'], 2.*data['plot_height']))
+
+    # data:
+    filter = temperature > T_min
+    ax[0].plot(time[filter], temperature[filter], ls='-', lw=1., zorder=999)
+    ax[0].set_xlim([np.amin(time[filter]), np.amax(time[filter])])
+
+    filter = smooth_temp > T_min
+    ax[0].plot(equi_time[filter], smooth_temp[filter], ls='-', lw=1., zorder=999)
+    ax[1].plot(equi_time[filter], temperature_der[filter], ls='-', lw=1., zorder=999)
+    ax[1].set_xlim([np.amin(equi_time[filter]), np.amax(equi_time[filter])])
+
+    # labels:
+    ax[0].set_ylabel('temperature [F]')
+    ax[1].set_xlabel('time [hours]')
+    ax[1].set_ylabel('temperature ramp [F/hour]')
+
+    _finalize(fig, ax, data, started, out_name, dpi)
+    return True
+
+
+def plot_ramp(data, started, out_name, dpi=100):
+    """
+    Plot the ramp rate of the whole fire.
+    """
+    equi_time, temperature_der = data['equi_time'], data['temperature_der']
+    fig, ax = plt.subplots(nrows=1, figsize=(data['plot_width'], data['plot_height']))
+    ax = [ax]
+
+    ax[0].plot(equi_time, temperature_der, ls='-', lw=1., zorder=999)
+    ax[0].axhline(0., ls='--', lw=1., color='k')
+    ax[0].set_xlim([np.amin(equi_time), np.amax(equi_time)])
+
+    # labels:
+    ax[0].set_xlabel('time [hours]')
+    ax[0].set_ylabel('temperature ramp [F/hour]')
+
+    _finalize(fig, ax, data, started, out_name, dpi)
+    return True
+
+
+def analyse_results(time, temperature, started, filename, analysis_settings={}):
+    """
+    Produce analysis plots and analyse the data after the fire.
+    time is the runtime in seconds, plots are saved in the filename folder.
+    """
+    # print feedback:
+    log.info('Analyzing results')
+
+    data = prepare(time, temperature, analysis_settings)
+    results = []
+    if plot_full(data, started, filename+'/1_full_results.pdf'):
+        results.append(filename+'/1_full_results.pdf')
+    if plot_peak(data, started, filename+'/2_peak_results.pdf', analysis_settings.get('peak_zoom', 300.)):
+        results.append(filename+'/2_peak_results.pdf')
+
+    # print feedback:
+    log.debug('Produced plots')
+    #
+    return results, data['report']
+
+
+def energy_report(energy):
+    """
+    Text of the energy and cost of a firing, with one line per segment of
+    the schedule. energy is the summary saved by the EnergyMeter.
+    """
+    currency = energy.get('currency', '')
+    lines = ['Energy = '+str(round(energy['energy'], 2))+' kWh, cost = '+currency+str(round(energy['cost'], 2))]
+    for segment in energy.get('segments', []):
+        if segment['start'] is not None and segment['end'] is not None:
+            span = ' (minutes '+str(int(segment['start']/60))+' to '+str(int(segment['end']/60))+')'
+        else:
+            span = ''
+        lines.append('  segment '+str(segment['segment']+1)+span+': '+str(round(segment['energy'], 2))+' kWh, '
+                     + currency+str(round(segment['cost'], 2)))
+    return '\n'.join(lines)
+
+
+def send_email_report(record_path, plot_files, report, started, destination, sender_name, sender_user, password,
+                      energy=None):
+    """
+    Send email report of the firing, energy is the summary of the energy
+    used if it was metered.
+    """
+    # print feedback:
+    log.info('Sending email results')
+
+    # create message:
+    msg = MIMEMultipart()
+    msg['Subject'] = '[kiln report] ' + started.strftime('%Y/%m/%d %H:%M')
+    msg['From'] = sender_name + ' <'+sender_user+'>'
+    msg['To'] = ", ".join(destination)
+    # email body:
+    body = 'Raw peak temperature = '+str(round(report['max_t'], 2))+' F'+'\n' \
+        + 'Average peak temperature = '+str(round(report['max_t_smooth'], 2))+' F'+'\n' \
+        + 'Firing duration = '+str(round(report['fire_duration'], 3))+' hours'
+    if energy:
+        body += '\n' + energy_report(energy)
+    msg.attach(MIMEText(body))
+    # attach plots:
+    for plot in plot_files:
+        msg.attach(MIMEText('\n\n', "plain"))
+        with open(plot, "rb") as f:
+            attach = MIMEApplication(f.read(), _subtype="pdf")
+        attach.add_header('Content-Disposition', 'attachment',
+                          filename=str(os.path.basename(plot)))
+        msg.attach(attach)
+    # attach raw data:
+    msg.attach(MIMEText('\n\n', "plain"))
+    with open(record_path, "rb") as f:
+        attach = MIMEApplication(f.read())
+    attach.add_header('Content-Disposition', 'attachment',
+                      filename=str(os.path.basename(record_path)))
+    msg.attach(attach)
+    # send the email:
+    server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+    server.ehlo()
+    server.login(sender_user, password)
+    server.send_message(msg)
+    server.close()
+
+    # print feedback:
+    log.debug('Email sent to: '+msg['To'])
+
+
+def send_email_start(started, tunnel_website, destination, sender_name, sender_user, password):
+    """
+    Send email to monitor fire
+    """
+    # print feedback:
+    log.info('Sending email at beginning of fire')
+
+    # create message:
+    msg = MIMEMultipart()
+    msg['Subject'] = '[kiln report] ' + started.strftime('%Y/%m/%d %H:%M')
+    msg['From'] = sender_name + ' <'+sender_user+'>'
+    msg['To'] = ", ".join(destination)
+    # email body:
+    if tunnel_website is not None:
+        msg.attach(MIMEText('Kiln monitor started, you can follow the fire at '+tunnel_website+'\n'))
+    else:
+        msg.attach(MIMEText('Kiln monitor started\n'))
+    # send the email:
+    server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+    server.ehlo()
+    server.login(sender_user, password)
+    server.send_message(msg)
+    server.close()
+
+    # print feedback:
+    log.debug('Initial email sent')
+
+
+def report_job(record_path, cache_path, analysis_settings, destination, sender_name, sender_user, password):
+    """
+    Analyse a saved firing and, if there is any destination, email the
+    report. This is what the report worker runs when a firing ends.
+    The PDFs are rendered in the plot cache, where the web pages find them.
+    """
+    from . import plots
+    record = HistoryRecord(record_path)
+    history_path = os.path.dirname(record_path)
+    run = os.path.splitext(os.path.basename(record_path))[0]
+    options = plots.plot_options(analysis_settings)
+    data = prepare(record.column('runtime'), record.column('temperature'), options)
+    report = data['report']
+    plot_files = [plots.render_plot(history_path, cache_path, run, 'full', 'pdf', options, data)]
+    if has_peak_zoom(data, options['peak_zoom']):
+        plot_files.append(plots.render_plot(history_path, cache_path, run, 'peak', 'pdf', options, data))
+    energy = record.header.get('energy')
+    if len(destination) > 0:
+        send_email_report(record_path, plot_files, report, record.started,
+                          destination, sender_name, sender_user, password, energy)
+    result = {key: float(value) for key, value in report.items()}
+    if energy:
+        result['energy'] = energy['energy']
+        result['cost'] = energy['cost']
+    return result
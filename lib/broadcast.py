@@ -0,0 +1,188 @@
+import threading
+import collections
+import logging
+import json
+import time
+
+import gevent
+from gevent.event import Event
+
+import config
+
+log = logging.getLogger(__name__)
+
+
+class Frame():
+    '''
+    a message for the observers, encoded at most once however many
+    observers it is sent to
+    '''
+    STATUS = "status"
+    OTHER = "other"
+
+    def __init__(self, message, kind=OTHER):
+        self.message = message
+        self.kind = kind
+        self._json = None
+
+    def encode(self):
+        if self._json is None:
+            if isinstance(self.message, str):
+                self._json = self.message
+            else:
+                self._json = json.dumps(self.message)
+        return self._json
+
+
+class Channel():
+    '''
+    Outgoing queue of one observer, drained by its own greenlet.
+
+    Frames can be queued from any thread. Status frames are coalesced: a
+    status frame that has not been sent yet is replaced by a newer one, as
+    only the latest state matters. The queue is bounded, when it is full
+    the oldest frame is dropped.
+    '''
+    def __init__(self, hub, wsock, maxlen, encoder=None):
+        self.hub = hub
+        self.wsock = wsock
+        self.encoder = encoder
+        self.maxlen = maxlen
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.behind_since = None
+        self.closed = False
+        # the greenlet lives in the gevent hub of the thread that created the
+        # channel, other threads wake it up through an async watcher
+        self._ready = Event()
+        self._async = gevent.get_hub().loop.async_()
+        self._async.start(self._wakeup)
+        self.greenlet = gevent.spawn(self._drain)
+
+    def depth(self):
+        return len(self.queue)
+
+    def put(self, frame):
+        with self.lock:
+            if self.closed:
+                return
+            if frame.kind == Frame.STATUS and self.queue and self.queue[-1].kind == Frame.STATUS:
+                self.queue[-1] = frame
+                self.coalesced += 1
+            else:
+                if len(self.queue) >= self.maxlen:
+                    self.queue.popleft()
+                    self.dropped += 1
+                self.queue.append(frame)
+            if self.behind_since is None:
+                self.behind_since = time.monotonic()
+        self._async.send()
+
+    def close(self):
+        '''stop the channel, safe to call from any thread'''
+        with self.lock:
+            self.closed = True
+            self.queue.clear()
+        self._async.send()
+
+    def _wakeup(self):
+        if self.closed:
+            self.greenlet.kill(block=False)
+            self._async.stop()
+            try:
+                self.wsock.close()
+            except Exception:
+                pass
+        else:
+            self._ready.set()
+
+    def _drain(self):
+        while not self.closed:
+            self._ready.wait()
+            self._ready.clear()
+            while True:
+                with self.lock:
+                    if not self.queue:
+                        self.behind_since = None
+                        break
+                    frame = self.queue.popleft()
+                try:
+                    if self.encoder is None:
+                        self.wsock.send(frame.encode())
+                    else:
+                        self.wsock.send(self.encoder.encode(frame))
+                    self.sent += 1
+                except Exception:
+                    log.error("could not write to socket %s" % self.wsock)
+                    self.hub.remove(self.wsock)
+                    return
+
+
+class BroadcastHub():
+    '''
+    Registry of the observers of a watcher. broadcast() only queues the
+    message for every observer, so a slow or dead client can not stall the
+    watcher or the other clients. Observers that stay behind longer than
+    evict_after seconds are dropped.
+    '''
+    def __init__(self, maxlen=config.status_queue_length, evict_after=config.status_evict_after):
+        self.maxlen = maxlen
+        self.evict_after = evict_after
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.evicted = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.channels)
+
+    def add(self, wsock, frame=None, encoder=None):
+        '''
+        register an observer, frame is queued before anything else.
+        The encoder, if any, turns frames into what is sent to this observer.
+        '''
+        channel = Channel(self, wsock, self.maxlen, encoder)
+        if frame is not None:
+            channel.put(frame)
+        with self.lock:
+            self.channels[id(wsock)] = channel
+        return channel
+
+    def remove(self, wsock):
+        with self.lock:
+            channel = self.channels.pop(id(wsock), None)
+        if channel is not None:
+            self.dropped += channel.dropped
+            channel.close()
+        return channel
+
+    def broadcast(self, message, kind=Frame.STATUS):
+        frame = message if isinstance(message, Frame) else Frame(message, kind)
+        with self.lock:
+            channels = list(self.channels.values())
+        now = time.monotonic()
+        for channel in channels:
+            behind_since = channel.behind_since
+            if behind_since is not None and now - behind_since > self.evict_after:
+                log.warning("evicting observer %s, %.0fs behind" % (channel.wsock, now - behind_since))
+                self.evicted += 1
+                self.remove(channel.wsock)
+                continue
+            channel.put(frame)
+        log.debug("queued %s frame for %d clients" % (frame.kind, len(channels)))
+
+    def get_stats(self):
+        with self.lock:
+            channels = list(self.channels.values())
+        return {
+            'observers': len(channels),
+            'queue_depth': [channel.depth() for channel in channels],
+            'max_queue_depth': max([channel.depth() for channel in channels] + [0]),
+            'dropped': self.dropped + sum(channel.dropped for channel in channels),
+            'coalesced': sum(channel.coalesced for channel in channels),
+            'sent': sum(channel.sent for channel in channels),
+            'evicted': self.evicted,
+        }
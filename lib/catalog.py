@@ -0,0 +1,193 @@
+import os
+import json
+import threading
+import logging
+
+import config
+from . import history
+
+log = logging.getLogger(__name__)
+
+
+def summarize(record, smoothing_scale=config.smoothing_scale,
+              unload_temperature=config.unload_temperature,
+              element_power=config.element_power):
+    '''
+    summary metrics of a history record. Durations are in hours and the
+    energy in kWh, as metered during the firing or, for older records,
+    estimated from the heater duty and element_power (W).
+    '''
+    import numpy as np
+    from . import utilities
+    profile = record.profile or {}
+    summary = {
+        'profile': profile.get('name'),
+        'started': record.header.get('started'),
+        'samples': len(record),
+        'duration': 0.,
+        'max_t': None,
+        'max_t_smooth': None,
+        'fire_duration': 0.,
+        'energy': 0.,
+        'cost': None,
+    }
+    if len(record) < 2:
+        return summary
+    time = np.asarray(record.column('runtime')) / 3600.
+    temperature = np.asarray(record.column('temperature'))
+    duty = np.clip(np.asarray(record.column('pid')), 0., 1.)
+    dt = np.diff(time)
+    summary['duration'] = float(time[-1] - time[0])
+    summary['max_t'] = float(np.amax(temperature))
+    # smoothed as in the report, on an equispaced grid:
+    equi_time = np.linspace(time[0], time[-1], len(time))
+    equi_temp = np.interp(equi_time, time, temperature)
+    try:
+        summary['max_t_smooth'] = float(np.amax(utilities.smooth_gaussian(equi_time, equi_temp, smoothing_scale)))
+    except ValueError:
+        summary['max_t_smooth'] = summary['max_t']
+    # as in the report:
+    summary['fire_duration'] = utilities.fire_duration(time, temperature, unload_temperature)
+    summary['energy'] = float(np.sum(duty[:-1] * dt) * element_power / 1000.)
+    metered = record.header.get('energy')
+    if metered:
+        summary['energy'] = metered['energy']
+        summary['cost'] = metered['cost']
+    return summary
+
+
+def summarize_file(path):
+    '''
+    summary of the record at path with the size and modification time the
+    catalog checks, what HistoryCatalog.put takes. Run by the report
+    worker when a firing ends.
+    '''
+    stat = os.stat(path)
+    summary = summarize(history.HistoryRecord(path))
+    summary.update({'file': os.path.basename(path), 'size': stat.st_size, 'mtime': stat.st_mtime})
+    return summary
+
+
+def summarize_files(path, names):
+    '''
+    summaries of the records names of the history directory path, see
+    summarize_file. Records that cannot be read are left out. Run by the
+    report worker for HistoryCatalog.stale.
+    '''
+    summaries = []
+    for name in names:
+        try:
+            summaries.append(summarize_file(os.path.join(path, name)))
+        except (OSError, ValueError, history.HistoryFormatError) as ex:
+            log.warning("could not index %s: %s" % (name, ex))
+    return summaries
+
+
+class HistoryCatalog():
+    '''
+    Index of the firing records in a history directory with cached summary
+    metrics, so that past firings can be listed and searched without
+    opening the records.
+
+    The index is kept in a JSON file next to the records. It is updated
+    when a record is added and, before a query, when the directory changed:
+    only records that are new or were modified since they were indexed are
+    opened, by refresh or, in the server, by the report worker.
+    '''
+    INDEX = "catalog.json"
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, self.INDEX)
+        self.entries = {}
+        self.dir_mtime = None
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                self.entries = json.load(f).get('entries', {})
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def put(self, summary):
+        '''index a record with the summary computed by summarize_file'''
+        self.update([summary])
+
+    def update(self, summaries):
+        '''index records with the summaries computed by summarize_files'''
+        with self.lock:
+            for summary in summaries:
+                self.entries[summary['file']] = summary
+            self._save()
+
+    def stale(self):
+        '''
+        drop the records that left the directory from the index and return
+        the names of those that are new or were modified since they were
+        indexed, to be summarized with summarize_files. Only the directory
+        is read here.
+        '''
+        with self.lock:
+            try:
+                dir_mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return []
+            if dir_mtime == self.dir_mtime:
+                return []
+            names = []
+            present = set()
+            for entry in os.scandir(self.path):
+                if not entry.name.endswith(history.EXTENSION):
+                    continue
+                present.add(entry.name)
+                stat = entry.stat()
+                cached = self.entries.get(entry.name)
+                if cached is None or cached['size'] != stat.st_size or cached['mtime'] != stat.st_mtime:
+                    names.append(entry.name)
+            gone = set(self.entries) - present
+            for name in gone:
+                del self.entries[name]
+            if gone:
+                self._save()
+            self.dir_mtime = dir_mtime
+            return sorted(names)
+
+    def refresh(self):
+        '''bring the index up to date with the directory, in this process'''
+        names = self.stale()
+        if names:
+            self.update(summarize_files(self.path, names))
+
+    def query(self, profile=None, since=None, until=None, min_peak=None, max_peak=None):
+        '''
+        summaries of the firings matching all the given filters, oldest
+        first. since and until are ISO dates or times, both included: a
+        firing matches until if it started at or before it at its precision,
+        so until=2021-01-31 includes that whole day. Peaks compare with max_t.
+        Only the index is read, see stale and refresh.
+        '''
+        results = []
+        for summary in list(self.entries.values()):
+            started = summary.get('started') or ''
+            if profile is not None and summary.get('profile') != profile:
+                continue
+            if since is not None and started < since:
+                continue
+            if until is not None and started[:len(until)] > until:
+                continue
+            peak = summary.get('max_t')
+            if min_peak is not None and (peak is None or peak < min_peak):
+                continue
+            if max_peak is not None and (peak is None or peak > max_peak):
+                continue
+            results.append(summary)
+        results.sort(key=lambda summary: summary.get('started') or '')
+        return results
@@ -0,0 +1,54 @@
+import time
+import datetime
+import threading
+
+
+class Clock():
+    '''
+    Wall clock, the default time source of the oven, its sensors and
+    watchers. Everything that needs the time or has to wait goes through
+    a clock so that simulations can run faster than real time.
+    '''
+    def monotonic(self):
+        return time.monotonic()
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        '''wait on a threading.Event, returns True if the event was set'''
+        return event.wait(max(timeout, 0.))
+
+
+class VirtualClock(Clock):
+    '''
+    Clock that only moves when told to. Sleeping advances the time right
+    away, so a single threaded simulation runs as fast as the CPU allows.
+    '''
+    def __init__(self, start=None):
+        self._time = 0.
+        self._start = start or datetime.datetime.now()
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        return self._time
+
+    def now(self):
+        return self._start + datetime.timedelta(seconds=self._time)
+
+    def advance(self, seconds):
+        with self._lock:
+            self._time += max(seconds, 0.)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, timeout):
+        if event.is_set():
+            return True
+        self.advance(timeout)
+        return event.is_set()
@@ -0,0 +1,97 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def lttb(x, y, threshold):
+    '''
+    Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the indexes of about threshold points of (x, y) that preserve
+    the visual shape of the curve, always including the first and last.
+    '''
+    import numpy as np
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    length = len(x)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+
+    indexes = np.zeros(threshold, dtype=int)
+    edges = np.linspace(1, length - 1, threshold - 1).astype(int)
+    a = 0
+    for i in range(threshold - 2):
+        # average of the next bucket is the third vertex of the triangle:
+        lo, hi = edges[i+1], edges[i+2] if i + 2 < len(edges) else length
+        avg_x, avg_y = np.mean(x[lo:hi]), np.mean(y[lo:hi])
+        # pick the point of this bucket with the largest triangle area:
+        bx, by = x[edges[i]:edges[i+1]], y[edges[i]:edges[i+1]]
+        if len(bx) == 0:
+            indexes[i+1] = a
+            continue
+        area = np.abs((x[a] - avg_x) * (by - y[a]) - (x[a] - bx) * (avg_y - y[a]))
+        a = edges[i] + int(np.argmax(area))
+        indexes[i+1] = a
+    indexes[-1] = length - 1
+    return np.unique(indexes)
+
+
+class MinMaxDownsampler():
+    '''
+    Incremental min/max bucket downsampler.
+
+    Samples are grouped in buckets of width consecutive samples and every
+    bucket keeps the samples with the lowest and highest value of key, so
+    peaks and holds survive. When there are more buckets than the point
+    budget allows, neighbouring buckets are merged and the width doubles.
+    The latest sample is always part of the result. Adding a sample is
+    amortized O(1) and the result never has more than maxpts points,
+    however long the firing.
+    '''
+    def __init__(self, maxpts, key='temperature'):
+        self.maxpts = maxpts
+        self.key = key
+        self.num_buckets = max((maxpts - 3) // 2, 1)
+        self.width = 1
+        self.buckets = []
+        self.current = None
+        self.count = 0
+        self.last = None
+
+    def _merge(self, first, second):
+        low = first[0] if first[0][self.key] <= second[0][self.key] else second[0]
+        high = first[1] if first[1][self.key] >= second[1][self.key] else second[1]
+        return (low, high)
+
+    def add(self, sample):
+        self.last = sample
+        if self.current is None:
+            self.current = (sample, sample)
+        else:
+            self.current = self._merge(self.current, (sample, sample))
+        self.count += 1
+        if self.count < self.width:
+            return
+        self.buckets.append(self.current)
+        self.current = None
+        self.count = 0
+        if len(self.buckets) > self.num_buckets:
+            self.buckets = [self._merge(*self.buckets[i:i+2]) if i + 1 < len(self.buckets)
+                            else self.buckets[i]
+                            for i in range(0, len(self.buckets), 2)]
+            self.width *= 2
+
+    def points(self):
+        '''the kept samples in the order they were added'''
+        buckets = self.buckets if self.current is None else self.buckets + [self.current]
+        points = []
+        for low, high in buckets:
+            if low is high:
+                points.append(low)
+            elif low['runtime'] <= high['runtime']:
+                points.extend((low, high))
+            else:
+                points.extend((high, low))
+        if self.last is not None and (not points or points[-1] is not self.last):
+            points.append(self.last)
+        return points
@@ -0,0 +1,96 @@
+import logging
+
+import config
+
+log = logging.getLogger(__name__)
+
+
+class EnergyMeter():
+    '''
+    Energy and cost of the firing in progress, integrated from the time the
+    heater output was on, as counted by the heater driver.
+
+    The control loop calls update() once per cycle with the total on time
+    of the heater, which costs O(1): the on time since the previous cycle is
+    converted to kWh with element_power (W) and added to the total and to
+    the segment of the schedule the firing is in.
+    '''
+    def __init__(self, element_power=config.element_power, kwh_rate=config.kwh_rate,
+                 currency=config.currency_type):
+        self.element_power = element_power
+        self.kwh_rate = kwh_rate
+        self.currency = currency
+        self.profile = None
+        self.energy = 0.
+        self.segments = []
+        self.segment = None
+        self.last_on_time = 0.
+
+    def start(self, profile, on_time):
+        '''start metering a firing, on_time is the current heater on time'''
+        self.profile = profile
+        self.energy = 0.
+        self.segments = [0.] * max(len(profile.data) - 1, 1)
+        self.segment = None
+        self.last_on_time = on_time
+
+    def _add(self, energy, runtime):
+        self.energy += energy
+        i = self.segment = self.profile.get_segment(runtime, self.segment)
+        if i is None:
+            i = len(self.segments) - 1
+        self.segments[i] += energy
+
+    def update(self, on_time, runtime):
+        '''account for the heater on time up to now, at runtime seconds'''
+        if self.profile is None:
+            return
+        seconds = max(on_time - self.last_on_time, 0.)
+        self.last_on_time = on_time
+        if seconds > 0:
+            self._add(seconds * self.element_power / 3.6e6, runtime)
+
+    def restore(self, samples):
+        '''
+        take the energy used before a firing was interrupted back from the
+        samples of its journal, see FiringJournal
+        '''
+        last = 0.
+        for sample in samples:
+            energy = sample.get('energy')
+            if energy is None:
+                continue
+            if energy > last:
+                self._add(energy - last, sample['runtime'])
+            last = energy
+
+    @property
+    def cost(self):
+        return self.energy * self.kwh_rate
+
+    def get_state(self):
+        return {
+            'energy': self.energy,
+            'cost': self.cost,
+        }
+
+    def summary(self):
+        '''totals and per segment breakdown, saved with the firing record'''
+        segments = []
+        times = self.profile.times if self.profile is not None else []
+        for i, energy in enumerate(self.segments):
+            segments.append({
+                'segment': i,
+                'start': times[i] if i < len(times) else None,
+                'end': times[i+1] if i + 1 < len(times) else None,
+                'energy': energy,
+                'cost': energy * self.kwh_rate,
+            })
+        return {
+            'energy': self.energy,
+            'cost': self.cost,
+            'currency': self.currency,
+            'kwh_rate': self.kwh_rate,
+            'element_power': self.element_power,
+            'segments': segments,
+        }
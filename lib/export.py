@@ -0,0 +1,88 @@
+"""
+Export of recorded firings, as CSV or as a .kiln record.
+
+The export is a generator of chunks of chunk_rows rows, meant to be
+returned by a bottle route so that the response is streamed: however long
+the firing, only one chunk of text is in memory at a time.
+"""
+import io
+import logging
+
+import config
+from . import history
+from .downsample import lttb
+
+log = logging.getLogger(__name__)
+
+FORMATS = {
+    'csv': ("text/csv", ".csv"),
+    'kiln': ("application/octet-stream", history.EXTENSION),
+}
+
+
+def select_rows(columns, start=None, end=None, maxpts=None):
+    '''
+    rows with start <= runtime < end as a slice, or as an array of indexes
+    when they are downsampled to maxpts points
+    '''
+    import numpy as np
+    runtime = columns['runtime']
+    lo = 0 if start is None else int(np.searchsorted(runtime, start, side='left'))
+    hi = len(runtime) if end is None else int(np.searchsorted(runtime, end, side='left'))
+    if maxpts is None or hi - lo <= maxpts:
+        return slice(lo, hi)
+    return lo + lttb(runtime[lo:hi], columns['temperature'][lo:hi], maxpts)
+
+
+def _chunks(rows, chunk_rows):
+    if isinstance(rows, slice):
+        for lo in range(rows.start, rows.stop, chunk_rows):
+            yield slice(lo, min(lo + chunk_rows, rows.stop))
+    else:
+        for lo in range(0, len(rows), chunk_rows):
+            yield rows[lo:lo + chunk_rows]
+
+
+def _count(rows):
+    return rows.stop - rows.start if isinstance(rows, slice) else len(rows)
+
+
+def iter_csv(columns, rows, chunk_rows=config.export_chunk_rows):
+    import numpy as np
+    names = list(columns)
+    yield ','.join(names) + '\n'
+    for chunk in _chunks(rows, chunk_rows):
+        out = io.StringIO()
+        np.savetxt(out, np.column_stack([columns[name][chunk] for name in names]),
+                   fmt='%.10g', delimiter=',')
+        yield out.getvalue()
+
+
+def iter_kiln(columns, rows, chunk_rows=config.export_chunk_rows, profile=None, started=None, **meta):
+    '''the bytes of a .kiln record of the selected rows, column by column'''
+    import numpy as np
+    yield history.encode_header(columns, _count(rows), profile, started, **meta)
+    for name in columns:
+        for chunk in _chunks(rows, chunk_rows):
+            yield np.ascontiguousarray(columns[name][chunk], dtype=history.DTYPE).tobytes()
+
+
+def export(source, format='csv', start=None, end=None, maxpts=None,
+           profile=None, started=None, chunk_rows=config.export_chunk_rows):
+    '''
+    export a telemetry buffer or a history record, start and end are
+    runtimes in seconds. Returns the content type, the file extension and
+    the generator of the chunks.
+    '''
+    if format not in FORMATS:
+        raise ValueError("unknown export format %s" % format)
+    # a consistent set of views, the live buffer can keep growing meanwhile
+    columns = source.columns()
+    rows = select_rows(columns, start, end, maxpts)
+    log.info("exporting %d rows as %s" % (_count(rows), format))
+    content_type, extension = FORMATS[format]
+    if format == 'csv':
+        chunks = iter_csv(columns, rows, chunk_rows)
+    else:
+        chunks = iter_kiln(columns, rows, chunk_rows, profile, started)
+    return content_type, extension, chunks
@@ -0,0 +1,158 @@
+"""
+Forecast of the firing in progress.
+
+Every forecast_interval seconds a background thread copies the state of the
+oven and its PID and runs the rest of the schedule through the thermal
+model on a virtual clock. It publishes when the schedule is expected to
+finish, the peak temperature the kiln is expected to reach and the segments
+where the kiln is expected to lag behind the schedule. The control loop is
+never blocked: the simulation only reads the oven state.
+"""
+import copy
+import threading
+import logging
+
+import config
+from clock import VirtualClock
+
+log = logging.getLogger(__name__)
+
+
+def to_model(temperature):
+    '''temperature in the display scale to the deg C of the thermal model'''
+    if config.temp_scale == "f":
+        return (temperature - 32.) * 5. / 9.
+    return temperature
+
+
+def from_model(temperature):
+    if config.temp_scale == "f":
+        return temperature * 9. / 5. + 32.
+    return temperature
+
+
+def _lag(slope, target, temperature):
+    '''how far the kiln is behind the schedule, going up or coming down'''
+    if slope < 0:
+        return temperature - target
+    return target - temperature
+
+
+def project(profile, runtime, temperature, model, pid, duty=0., holding=False,
+            time_step=config.forecast_time_step, lag_tolerance=config.forecast_lag_tolerance,
+            horizon=config.forecast_horizon):
+    '''
+    run the rest of profile from runtime (seconds) and temperature (display
+    scale) through model, a ThermalModel, controlled by pid, a PID that is
+    driven by a virtual clock here. duty is the current heater duty, used
+    to guess the temperature of the elements. With holding the schedule
+    waits until the kiln is within resume_hold_tolerance of the target, as
+    the oven does.
+
+    Returns a dictionary with finish (seconds from now until the schedule
+    ends, None if that is beyond horizon hours), peak and peak_time (seconds
+    from now) and the segments where the lag exceeds lag_tolerance degrees.
+    '''
+    clock = VirtualClock()
+    pid.clock = clock
+    pid.lastNow = clock.monotonic()
+    t = to_model(temperature - config.thermocouple_offset)
+    model.reset(t, t + max(duty, 0.) * model.p_heat * model.R_ho)
+
+    totaltime = profile.get_duration()
+    peak, peak_time = temperature, 0.
+    lags = {}
+    elapsed = 0.
+    finish = None
+    i = None
+    while elapsed <= horizon * 3600.:
+        if runtime >= totaltime:
+            finish = elapsed
+            break
+        measured = from_model(model.t) + config.thermocouple_offset
+        i = profile.get_segment(runtime, i)
+        target = profile.get_target_temperature(runtime, i)
+        if holding and measured >= target - config.resume_hold_tolerance:
+            holding = False
+        if i is not None:
+            lag = _lag(profile.slopes[i], target, measured)
+            segment = lags.get(i)
+            if segment is None or lag > segment['lag']:
+                lags[i] = {'segment': i, 'lag': lag, 'runtime': runtime}
+        if measured > peak:
+            peak, peak_time = measured, elapsed
+        clock.advance(time_step)
+        output = pid.compute(target, measured)
+        model.step(time_step, max(output, 0.))
+        elapsed += time_step
+        if not holding:
+            runtime += time_step
+
+    lagging = [segment for i, segment in sorted(lags.items()) if segment['lag'] > lag_tolerance]
+    for segment in lagging:
+        i = segment['segment']
+        segment.update({'start': profile.times[i], 'end': profile.times[i+1]})
+    return {
+        'finish': finish,
+        'peak': peak,
+        'peak_time': peak_time,
+        'lagging': lagging,
+    }
+
+
+class Forecaster(threading.Thread):
+    '''
+    Thread forecasting the firing of oven every interval seconds. listener
+    is called with every new forecast, or None when the oven stops.
+    '''
+    def __init__(self, oven, interval=config.forecast_interval, listener=None, clock=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.oven = oven
+        self.interval = interval
+        self.listener = listener
+        self.clock = clock or oven.clock
+        self.forecast = None
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                self.update()
+            except Exception:
+                log.exception("forecast failed")
+            self.clock.sleep(self.interval)
+
+    def update(self):
+        oven = self.oven
+        state = oven.get_state()
+        profile = oven.profile
+        if state['state'] != oven.STATE_RUNNING or profile is None:
+            if self.forecast is not None:
+                self.forecast = None
+                self._publish()
+            return
+        pid = copy.copy(oven.pid)
+        forecast = project(profile, state['runtime'], state['temperature'],
+                           oven.get_model(), pid, duty=state['pid'],
+                           holding=state.get('holding', False))
+        forecast['runtime'] = state['runtime']
+        forecast['computed'] = self.clock.monotonic()
+        log.debug("forecast: finish=%s, peak=%.1f, lagging=%d" %
+                  (forecast['finish'], forecast['peak'], len(forecast['lagging'])))
+        self.forecast = forecast
+        self._publish()
+
+    def _publish(self):
+        if self.listener is not None:
+            self.listener(self.forecast)
+
+    def get_state(self):
+        '''fields of the status frames'''
+        forecast = self.forecast
+        if forecast is None:
+            return {'forecast_time_left': None, 'forecast_peak': None}
+        time_left = None
+        if forecast['finish'] is not None:
+            time_left = max(forecast['finish'] - (self.clock.monotonic() - forecast['computed']), 0.)
+        return {'forecast_time_left': time_left, 'forecast_peak': forecast['peak']}
@@ -0,0 +1,175 @@
+import threading
+import logging
+
+from clock import Clock
+
+log = logging.getLogger(__name__)
+
+try:
+    import RPi.GPIO as GPIO
+    gpio_available = True
+except ImportError:
+    msg = "Could not initialize GPIOs, oven operation will only be simulated!"
+    log.warning(msg)
+    gpio_available = False
+
+
+class GPIOBackend():
+    '''drives the solid state relay through RPi.GPIO'''
+    def __init__(self, pin, invert=False):
+        self.pin = pin
+        self.invert = invert
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        GPIO.setup(self.pin, GPIO.OUT)
+
+    def write(self, on):
+        if bool(on) != bool(self.invert):
+            GPIO.output(self.pin, GPIO.HIGH)
+        else:
+            GPIO.output(self.pin, GPIO.LOW)
+
+
+class NullBackend():
+    '''used when there are no GPIOs, the output goes nowhere'''
+    def write(self, on):
+        pass
+
+
+class FakeGPIOBackend():
+    '''
+    records every edge written to it as (time, on), for testing
+    the driver without hardware
+    '''
+    def __init__(self, clock=None):
+        self.clock = clock or Clock()
+        self.edges = []
+
+    def write(self, on):
+        self.edges.append((self.clock.monotonic(), bool(on)))
+
+
+class HeaterDriver(threading.Thread):
+    '''
+    Owns the heater output and turns a duty value (0-1) into switching of
+    the relay, on its own timeline so that the control loop never blocks.
+
+    Modes:
+    - "time_proportioning": every cycle the output is on for duty * cycle_time
+      and off for the rest of the cycle
+    - "burst": the cycle is split in mains half-cycles and whole half-cycles
+      are fired, spread as evenly as possible. The fraction that does not fit
+      in one cycle is carried over to the next one.
+
+    A duty change is applied at the start of the next cycle, except for a
+    duty of zero which switches the output off right away.
+    '''
+    MODE_TIME_PROPORTIONING = "time_proportioning"
+    MODE_BURST = "burst"
+
+    def __init__(self, backend, cycle_time, mode=MODE_TIME_PROPORTIONING,
+                 mains_frequency=60, clock=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if mode not in (self.MODE_TIME_PROPORTIONING, self.MODE_BURST):
+            raise ValueError("unknown heater mode %s" % mode)
+        self.backend = backend
+        self.cycle_time = float(cycle_time)
+        self.mode = mode
+        self.half_cycle = 1. / (2. * mains_frequency)
+        self.clock = clock or Clock()
+        self.duty = 0.
+        self.output = False
+        self.on_since = None
+        self.on_time = 0.         # total seconds the output has been on
+        self.last_on_time = 0.    # seconds on during the last full cycle
+        self.last_duty = 0.       # delivered duty of the last full cycle
+        self.cycles = 0
+        self._burst_acc = 0.
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.backend.write(False)
+
+    def set_duty(self, duty):
+        self.duty = min(max(float(duty), 0.), 1.)
+        if self.duty <= 0:
+            # switching off can not wait for the end of the cycle
+            self._wake.set()
+
+    def get_on_time(self):
+        '''total delivered on time in seconds, including a running pulse'''
+        with self._lock:
+            if self.output:
+                return self.on_time + self.clock.monotonic() - self.on_since
+            return self.on_time
+
+    def _write(self, on):
+        with self._lock:
+            if on == self.output:
+                return
+            now = self.clock.monotonic()
+            if on:
+                self.on_since = now
+            else:
+                self.on_time += now - self.on_since
+                self.on_since = None
+            self.output = on
+            self.backend.write(on)
+
+    def _wait_until(self, when):
+        '''wait until the given time, returns False if woken up by a switch off'''
+        while True:
+            remaining = when - self.clock.monotonic()
+            if remaining <= 0:
+                return True
+            if self.clock.wait(self._wake, remaining):
+                self._wake.clear()
+                if self.duty <= 0:
+                    return False
+
+    def plan(self, duty):
+        '''
+        list of (offset, on) switching points in a cycle for the given duty
+        '''
+        if self.mode == self.MODE_TIME_PROPORTIONING:
+            on_time = duty * self.cycle_time
+            if on_time <= 0:
+                return [(0., False)]
+            if on_time >= self.cycle_time:
+                return [(0., True)]
+            return [(0., True), (on_time, False)]
+
+        # burst firing, error diffusion over whole half-cycles:
+        points = []
+        level = None
+        num_half_cycles = max(1, int(round(self.cycle_time / self.half_cycle)))
+        for i in range(num_half_cycles):
+            self._burst_acc += duty
+            on = self._burst_acc >= 1.
+            if on:
+                self._burst_acc -= 1.
+            if on != level:
+                points.append((i * self.half_cycle, on))
+                level = on
+        return points
+
+    def run_cycle(self, start):
+        '''run one cycle starting at the given clock time'''
+        on_time_start = self.get_on_time()
+        for offset, on in self.plan(self.duty):
+            if not self._wait_until(start + offset):
+                # switched off in the middle of the cycle
+                self._write(False)
+                break
+            self._write(on)
+        end = start + self.cycle_time
+        self._wait_until(end)
+        self.last_on_time = self.get_on_time() - on_time_start
+        self.last_duty = self.last_on_time / self.cycle_time
+        self.cycles += 1
+        return end
+
+    def run(self):
+        start = self.clock.monotonic()
+        while True:
+            start = self.run_cycle(start)
@@ -0,0 +1,159 @@
+"""
+On-disk format of the firing history.
+
+A record is a .kiln file made of a fixed preamble, a JSON header and the
+raw columns:
+
+    magic      8 bytes  b"KILNHIST"
+    version    uint32   little endian
+    header     uint32   little endian, length of the JSON header in bytes
+    JSON header         profile, start time, column names, number of rows
+    padding             up to the next multiple of ALIGNMENT
+    columns             one little endian float64 array per column, rows long
+
+Columns are stored one after the other so every column can be memory
+mapped on its own. Opening a record only reads the header, and a slice of
+a long firing only touches the pages of the rows that are asked for.
+"""
+import os
+import json
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"KILNHIST"
+VERSION = 1
+ALIGNMENT = 64
+EXTENSION = ".kiln"
+DTYPE = '<f8'
+
+_PREAMBLE = struct.Struct('<8sII')
+
+
+class HistoryFormatError(Exception):
+    pass
+
+
+def encode_header(columns, rows, profile=None, started=None, **meta):
+    '''preamble, JSON header and padding of a record, up to the first column'''
+    header = {
+        'columns': list(columns),
+        'rows': rows,
+        'dtype': DTYPE,
+        'profile': profile,
+        'started': started.isoformat() if started is not None else None,
+    }
+    header.update(meta)
+    encoded = json.dumps(header).encode('utf-8')
+    padding = -(_PREAMBLE.size + len(encoded)) % ALIGNMENT
+    return _PREAMBLE.pack(MAGIC, VERSION, len(encoded)) + encoded + b'\0' * padding
+
+
+def write_record(path, log_buffer, profile=None, started=None, **meta):
+    '''
+    write the columns of a telemetry buffer (anything with a COLUMNS
+    attribute and a column(name) method) to path, atomically.
+    Extra keyword arguments are stored in the header.
+    '''
+    import numpy as np
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_header(log_buffer.COLUMNS, len(log_buffer), profile, started, **meta))
+        for name in log_buffer.COLUMNS:
+            f.write(np.ascontiguousarray(log_buffer.column(name), dtype=DTYPE).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+class HistoryRecord():
+    '''
+    A firing record opened for reading. Only the header is read when the
+    record is opened, columns are memory mapped on first use.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            preamble = f.read(_PREAMBLE.size)
+            if len(preamble) < _PREAMBLE.size:
+                raise HistoryFormatError("%s is too short to be a history record" % path)
+            magic, version, length = _PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise HistoryFormatError("%s is not a history record" % path)
+            if version > VERSION:
+                raise HistoryFormatError("%s has version %d, only %d is supported" % (path, version, VERSION))
+            self.version = version
+            self.header = json.loads(f.read(length).decode('utf-8'))
+        offset = _PREAMBLE.size + length
+        self.offset = offset + (-offset % ALIGNMENT)
+        self.rows = self.header['rows']
+        self.COLUMNS = tuple(self.header['columns'])
+        self._columns = {}
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def profile(self):
+        return self.header.get('profile')
+
+    @property
+    def started(self):
+        import datetime
+        started = self.header.get('started')
+        return datetime.datetime.fromisoformat(started) if started else None
+
+    def column(self, name):
+        '''read-only memory map of a column'''
+        column = self._columns.get(name)
+        if column is None:
+            import numpy as np
+            index = self.COLUMNS.index(name)
+            if self.rows == 0:
+                column = np.zeros(0, dtype=DTYPE)
+            else:
+                column = np.memmap(self.path, dtype=DTYPE, mode='r', shape=(self.rows,),
+                                   offset=self.offset + index * self.rows * 8)
+            self._columns[name] = column
+        return column
+
+    def columns(self):
+        return {name: self.column(name) for name in self.COLUMNS}
+
+    def slice(self, start=None, end=None, key='runtime'):
+        '''
+        the rows with start <= key < end as a dictionary of arrays. The key
+        column is searched by bisection, so only the pages it touches and
+        the selected rows are read.
+        '''
+        import numpy as np
+        keys = self.column(key)
+        lo = 0 if start is None else int(np.searchsorted(keys, start, side='left'))
+        hi = self.rows if end is None else int(np.searchsorted(keys, end, side='left'))
+        return {name: np.array(self.column(name)[lo:hi]) for name in self.COLUMNS}
+
+
+def convert_pickle(pickle_path, out_path=None):
+    '''
+    migrate a record pickled by older versions to the columnar format.
+    Unpickling runs code from the file, only convert records you made.
+    '''
+    import pickle
+    from .telemetry import TelemetryBuffer
+    with open(pickle_path, 'rb') as handle:
+        record = pickle.load(handle)
+    last_log = record.get('last_log')
+    if isinstance(last_log, list):
+        last_log = TelemetryBuffer.from_records(last_log, capacity=None)
+    profile = record.get('last_profile')
+    if profile is not None:
+        profile = {'name': profile.name, 'data': profile.data, 'type': "profile"}
+    if out_path is None:
+        out_path = os.path.splitext(pickle_path)[0] + EXTENSION
+    log.info("converting %s to %s" % (pickle_path, out_path))
+    return write_record(out_path, last_log,
+                        profile=profile,
+                        started=record.get('started'),
+                        analysis_settings=record.get('analysis_settings', {}))
@@ -0,0 +1,160 @@
+import os
+import json
+import logging
+import threading
+
+import config
+from clock import Clock
+
+log = logging.getLogger(__name__)
+
+
+class FiringJournal():
+    '''
+    Append-only journal of the firing in progress, written by the control
+    loop so that a crash or a power cut does not lose the firing.
+
+    The journal is a text file with one JSON record per line: a "start"
+    record with the profile, one "sample" record per control cycle and an
+    "end" record when the firing stops. Records go through the file buffer
+    and are flushed and fsync'ed at most every fsync_interval seconds, so
+    the SD card sees about one page write per interval. A power cut loses
+    at most the last interval and a partial last line, which is skipped
+    when the journal is read back.
+
+    The control loop writes the samples while the firing can be started or
+    stopped from the web server, a lock keeps them from interleaving.
+    '''
+    def __init__(self, path=config.journal_path,
+                 fsync_interval=config.journal_fsync_interval, clock=None):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.clock = clock or Clock()
+        self.file = None
+        self.last_sync = 0
+        self.lock = threading.Lock()
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = self.clock.monotonic()
+
+    def start(self, profile, startat=0, resume=False):
+        '''
+        start the journal of a new firing, startat is in minutes. With
+        resume the interrupted firing of the journal goes on: its records
+        are kept and a "resume" record is appended.
+        '''
+        with self.lock:
+            self._start(profile, startat, resume)
+
+    def _start(self, profile, startat, resume):
+        if self.file is not None:
+            self._end("restarted")
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if resume and os.path.isfile(self.path):
+            self.file = open(self.path, 'a')
+            self._write({'type': "resume",
+                         'startat': startat,
+                         'wall': self.clock.now().timestamp()})
+        else:
+            self.file = open(self.path, 'w')
+            self._write({'type': "start",
+                         'profile': {'name': profile.name, 'data': profile.data, 'type': "profile"},
+                         'startat': startat,
+                         'wall': self.clock.now().timestamp()})
+        self._sync()
+
+    def sample(self, state):
+        with self.lock:
+            self._sample(state)
+
+    def _sample(self, state):
+        if self.file is None:
+            return
+        record = {'type': "sample", 'wall': round(self.clock.now().timestamp(), 1)}
+        for name in ('runtime', 'temperature', 'target', 'heat', 'pid'):
+            record[name] = round(state.get(name) or 0., 3)
+        if 'energy' in state:
+            record['energy'] = round(state['energy'], 4)
+        self._write(record)
+        if self.clock.monotonic() - self.last_sync >= self.fsync_interval:
+            self._sync()
+
+    def end(self, reason="completed", energy=None):
+        '''close the journal, energy is the summary of the EnergyMeter'''
+        with self.lock:
+            self._end(reason, energy)
+
+    def _end(self, reason, energy=None):
+        if self.file is None:
+            return
+        record = {'type': "end", 'reason': reason, 'wall': self.clock.now().timestamp()}
+        if energy is not None:
+            record['energy'] = energy
+        self._write(record)
+        self._sync()
+        self.file.close()
+        self.file = None
+
+    @staticmethod
+    def read(path=config.journal_path):
+        '''
+        read back a journal: returns (start record, list of samples, end record)
+        or None if there is no journal. A damaged last line is skipped.
+        '''
+        if not os.path.isfile(path):
+            return None
+        start, samples, end = None, [], None
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    log.warning("skipping damaged journal record in %s" % path)
+                    continue
+                if record.get('type') == "start":
+                    start, samples, end = record, [], None
+                elif record.get('type') == "sample":
+                    samples.append(record)
+                elif record.get('type') == "end":
+                    end = record
+                elif record.get('type') == "resume":
+                    end = None
+        if start is None:
+            return None
+        return start, samples, end
+
+    @staticmethod
+    def find_interrupted(path=config.journal_path, max_outage=config.journal_max_outage, now=None):
+        '''
+        describe the firing of the journal if it was interrupted less than
+        max_outage minutes ago, so that it can be resumed, otherwise None
+        '''
+        journal = FiringJournal.read(path)
+        if journal is None:
+            return None
+        start, samples, end = journal
+        if end is not None:
+            return None
+        last = samples[-1] if samples else start
+        now = now if now is not None else Clock().now().timestamp()
+        outage = now - last['wall']
+        if outage > max_outage * 60:
+            log.info("interrupted firing found in %s, but power was out for %d minutes" % (path, outage / 60))
+            return None
+        runtime = samples[-1]['runtime'] if samples else start['startat'] * 60
+        return {
+            'profile': start['profile'],
+            'runtime': runtime,
+            'startat': runtime / 60.,
+            'temperature': samples[-1]['temperature'] if samples else None,
+            'outage': outage,
+            'samples': samples,
+            'started': start['wall'] - start['startat'] * 60,
+        }
@@ -0,0 +1,159 @@
+"""
+Import of the firings logged by the controller in daemon.log.
+
+Oven.run logs a line per control cycle, see docs/logs.md:
+
+    2019-01-21 06:25:40,390 INFO oven: temp=1092.4, target=1093.2, pid=1.000, heat_on=2.00, heat_off=0.00, run_time=15993, total_time=48780, time_left=32786
+
+The logs are read in large blocks and scanned with one compiled regular
+expression, lines of other programs are never decoded. Samples are split in
+firings when the run time goes back, the schedule changes or the log has a
+gap, and every firing is written to the history as a .kiln record.
+"""
+import os
+import re
+import gzip
+import datetime
+import logging
+from array import array
+
+from . import history
+from .telemetry import TelemetryBuffer
+
+log = logging.getLogger(__name__)
+
+LINE = re.compile(
+    rb'(?:(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)[,.]\d+ )?INFO (?:lib\.)?oven: '
+    rb'temp\s*=\s*(-?[\d.]+), target=(-?[\d.]+), pid=(-?[\d.]+), '
+    rb'heat_on=(-?[\d.]+), heat_off=(-?[\d.]+), run_time=(-?\d+), total_time=(-?\d+)')
+
+BLOCK_SIZE = 1 << 20
+
+
+def rotation_order(paths):
+    '''sort rotated logs oldest first: daemon.log.3.gz, daemon.log.2.gz, daemon.log.1, daemon.log'''
+    def key(path):
+        name = os.path.basename(path)
+        if name.endswith('.gz'):
+            name = name[:-3]
+        suffix = name.rsplit('.', 1)[-1]
+        return (-int(suffix) if suffix.isdigit() else 0, path)
+    return sorted(paths, key=key)
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_matches(stream, block_size=BLOCK_SIZE):
+    '''matches of LINE in a binary stream, read block by block'''
+    tail = b''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        block = tail + block
+        end = block.rfind(b'\n') + 1
+        tail = block[end:]
+        yield from LINE.finditer(block, 0, end)
+    if tail:
+        yield from LINE.finditer(tail)
+
+
+class Run():
+    '''samples of one firing, stored by column'''
+    COLUMNS = TelemetryBuffer.COLUMNS
+
+    def __init__(self, total_time, wall):
+        self.total_time = total_time
+        self.first_wall = wall
+        self.last_wall = wall
+        self._columns = {name: array('d') for name in self.COLUMNS}
+
+    def __len__(self):
+        return len(self._columns['seq'])
+
+    def column(self, name):
+        return self._columns[name]
+
+    def add(self, runtime, temperature, target, heat_on, pid, wall):
+        columns = self._columns
+        columns['seq'].append(len(columns['seq']) + 1)
+        columns['runtime'].append(runtime)
+        columns['temperature'].append(temperature)
+        columns['target'].append(target)
+        columns['heat'].append(1. if heat_on > 0 else 0.)
+        columns['pid'].append(pid)
+        if wall is not None:
+            self.last_wall = wall
+
+    @property
+    def started(self):
+        if self.first_wall is None:
+            return None
+        return self.first_wall - datetime.timedelta(seconds=self._columns['runtime'][0])
+
+
+def iter_runs(paths, max_gap=600):
+    '''
+    firings found in the logs, in order. A new firing starts when the run
+    time goes back, the total time of the schedule changes or no line was
+    logged for max_gap seconds.
+    '''
+    run = None
+    for path in rotation_order(paths):
+        log.info("reading %s" % path)
+        with open_log(path) as stream:
+            for match in iter_matches(stream):
+                stamp, temp, target, pid, heat_on, heat_off, run_time, total_time = match.groups()
+                wall = datetime.datetime.fromisoformat(stamp.decode()) if stamp else None
+                runtime = float(run_time)
+                total_time = int(total_time)
+                if run is not None:
+                    gap = wall is not None and run.last_wall is not None and \
+                        (wall - run.last_wall).total_seconds() > max_gap
+                    if runtime < run.column('runtime')[-1] or total_time != run.total_time or gap:
+                        yield run
+                        run = None
+                if run is None:
+                    run = Run(total_time, wall)
+                run.add(runtime, float(temp), float(target), float(heat_on), float(pid), wall)
+    if run is not None:
+        yield run
+
+
+def match_profile(run, profiles):
+    '''the profile whose duration is the total time of the run, if any'''
+    for profile in profiles:
+        data = profile.get('data') or []
+        if data and int(data[-1][0]) == run.total_time:
+            return profile
+    return None
+
+
+def import_logs(paths, history_path, profiles=(), min_samples=10, max_gap=600):
+    '''
+    import the firings of the logs in the history, firings that were
+    already imported are skipped. Returns the paths of the new records.
+    '''
+    written = []
+    for run in iter_runs(paths, max_gap):
+        if len(run) < min_samples:
+            continue
+        started = run.started
+        if started is None:
+            log.warning("skipping a firing of %d samples without timestamps" % len(run))
+            continue
+        out_name = os.path.join(history_path, started.strftime('%Y_%m_%d-%H_%M') + history.EXTENSION)
+        if os.path.exists(out_name):
+            log.info("%s already in the history" % out_name)
+            continue
+        history.write_record(out_name, run,
+                             profile=match_profile(run, profiles),
+                             started=started,
+                             imported=True)
+        log.info("imported %d samples to %s" % (len(run), out_name))
+        written.append(out_name)
+    return written
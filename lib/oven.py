@@ -1,12 +1,16 @@
 import threading
-import time
 import random
-import datetime
+import bisect
 import logging
 import json
 import requests
 
 import config
+from clock import Clock
+from scheduler import FixedRateScheduler
+from heaterDriver import HeaterDriver, GPIOBackend, NullBackend, gpio_available
+from energy import EnergyMeter
+from forecast import from_model
 
 log = logging.getLogger(__name__)
 
@@ -32,60 +36,83 @@ except ImportError:
     log.exception("Could not initialize temperature sensor, using dummy values!")
     sensor_available = False
 
-try:
-    import RPi.GPIO as GPIO
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-    GPIO.setup(config.gpio_heat, GPIO.OUT)
-    gpio_available = True
-except ImportError:
-    msg = "Could not initialize GPIOs, oven operation will only be simulated!"
-    log.warning(msg)
-    gpio_available = False
-
 class Oven (threading.Thread):
     STATE_IDLE = "IDLE"
     STATE_RUNNING = "RUNNING"
 
-    def __init__(self, simulate=False, time_step=config.sensor_time_wait):
+    def __init__(self, simulate=False, time_step=config.sensor_time_wait, clock=None, journal=None):
         threading.Thread.__init__(self)
         self.daemon = True
         self.simulate = simulate
         self.time_step = time_step
+        self.clock = clock or Clock()
+        self.journal = journal
+        self.state = Oven.STATE_IDLE
         self.temp_sensor = None
+        if gpio_available:
+            backend = GPIOBackend(config.gpio_heat, invert=config.heater_invert)
+        else:
+            backend = NullBackend()
+        self.heater = HeaterDriver(backend,
+                                   cycle_time=self.time_step,
+                                   mode=config.heater_mode,
+                                   mains_frequency=config.mains_frequency,
+                                   clock=self.clock)
+        self.heater.start()
+        self.energy = EnergyMeter()
+        self.scheduler = FixedRateScheduler(self.time_step,
+                                            policy=config.control_loop_policy,
+                                            clock=self.clock)
         self.reset()
-        if simulate:
+        if simulate or not sensor_available:
             self.temp_sensor = TempSensorSimulate(self,
                                                   self.time_step,
-                                                  self.time_step)
-        if sensor_available:
-            self.temp_sensor = TempSensorReal(self.time_step)
-        else:
-            self.temp_sensor = TempSensorSimulate(self,
                                                   self.time_step,
-                                                  self.time_step)
+                                                  clock=self.clock)
+        else:
+            self.temp_sensor = TempSensorReal(self.time_step, clock=self.clock)
         self.temp_sensor.start()
         self.start()
 
-    def reset(self):
+    def reset(self, reason="aborted"):
+        if self.state == Oven.STATE_RUNNING:
+            # the totals are kept until the next firing starts
+            self.energy.update(self.heater.get_on_time(), self.runtime)
+            if self.journal is not None:
+                self.journal.end(reason, energy=self.energy.summary())
         self.profile = None
         self.start_time = 0
         self.runtime = 0
         self.totaltime = 0
         self.target = 0
+        # segment of the profile at runtime, the lookup hint of the loop
+        self.segment = None
+        self.pid_output = 0
+        self.holding = False
         self.state = Oven.STATE_IDLE
         self.set_heat(False)
-        self.pid = PID(ki=config.pid_ki, kd=config.pid_kd, kp=config.pid_kp)
+        self.pid = PID(ki=config.pid_ki, kd=config.pid_kd, kp=config.pid_kp, clock=self.clock)
         if self.temp_sensor is not None:
             self.temp_sensor.active = False
 
-    def run_profile(self, profile, startat=0):
+    def run_profile(self, profile, startat=0, hold=False):
+        '''
+        run a profile starting at minute startat. With hold the schedule
+        waits at startat until the kiln is within resume_hold_tolerance of
+        the target, which is used when resuming after a power outage.
+        '''
         log.info("Running schedule %s" % profile.name)
         self.profile = profile
         self.totaltime = profile.get_duration()
-        self.state = Oven.STATE_RUNNING
-        self.start_time = datetime.datetime.now()
+        self.segment = None
+        self.start_time = self.clock.monotonic()
         self.startat = startat * 60
+        self.holding = hold
+        self.energy.start(profile, self.heater.get_on_time())
+        if self.journal is not None:
+            # holding is how an interrupted firing is resumed, its journal goes on
+            self.journal.start(profile, startat, resume=hold)
+        self.state = Oven.STATE_RUNNING
         self.temp_sensor.active = True
         log.info("Starting")
 
@@ -96,20 +123,34 @@ class Oven (threading.Thread):
         temperature_count = 0
         last_temp = 0
         pid = 0
+        self.scheduler.reset()
+        last_stats = self.clock.monotonic()
         while True:
 
+            # wait for the next deadline, time spent in the previous
+            # iteration (logging, pid, sensor, heating) is accounted for
+            tick = self.scheduler.wait()
+            log.debug("tick %d: overrun=%.3f, jitter=%.3f, skipped=%d" %
+                      (tick.index, tick.overrun, tick.jitter, tick.skipped))
+            if tick.woke - last_stats >= config.control_loop_stats_interval:
+                last_stats = tick.woke
+                log.info("control loop: ticks=%(ticks)d, late=%(late_ticks)d, skipped=%(skipped)d, "
+                         "max_overrun=%(max_overrun).3f, max_jitter=%(max_jitter).3f" % self.scheduler.get_stats())
+
             if self.state == Oven.STATE_RUNNING:
-                if self.simulate:
-                    self.runtime += 0.5
-                else:
-                    runtime_delta = datetime.datetime.now() - self.start_time
-                    if self.startat > 0:
-                        self.runtime = self.startat + runtime_delta.total_seconds();
-                    else:
-                        self.runtime = runtime_delta.total_seconds()
-
-                self.target = self.profile.get_target_temperature(self.runtime)
+                if self.holding:
+                    # the schedule does not move until the kiln catches up
+                    self.start_time = self.clock.monotonic()
+                    target = self.profile.get_target_temperature(self.startat)
+                    if self.temp_sensor.temperature + config.thermocouple_offset >= target - config.resume_hold_tolerance:
+                        log.info("temperature caught up with the schedule, resuming")
+                        self.holding = False
+                self.runtime = self.startat + self.clock.monotonic() - self.start_time
+
+                self.segment = self.profile.get_segment(self.runtime, self.segment)
+                self.target = self.profile.get_target_temperature(self.runtime, self.segment)
                 pid = self.pid.compute(self.target, self.temp_sensor.temperature + config.thermocouple_offset)
+                self.pid_output = pid
 
                 heat_on = float(0)
                 heat_off = float(self.time_step)
@@ -136,46 +177,32 @@ class Oven (threading.Thread):
                 # if we are WAY TOO HOT, shut down
                 if(self.temp_sensor.temperature + config.thermocouple_offset >= config.emergency_shutoff_temp):
                     log.info("emergency!!! temperature too high, shutting down")
-                    self.reset()
+                    self.reset("emergency")
+                    continue
 
-                #Capture the last temperature value.  This must be done before set_heat, since there is a sleep in there now.
                 last_temp = self.temp_sensor.temperature + config.thermocouple_offset
 
                 self.set_heat(pid)
+                self.energy.update(self.heater.get_on_time(), self.runtime)
+
+                if self.journal is not None:
+                    self.journal.sample(self.get_state())
 
                 if self.runtime >= self.totaltime:
                     log.info("schedule ended, shutting down")
-                    self.reset()
-
-            # amount of time to sleep with the heater off
-            # for example if pid = .6 and time step is 1, sleep for .4s
-            if pid > 0:
-                time.sleep(self.time_step * (1 - pid))
-            else:
-                time.sleep(self.time_step)
+                    self.reset("completed")
 
     def set_heat(self, value):
+        '''hand the duty over to the heater driver, this does not block'''
         if value > 0:
             self.heat = 1.0
-            if gpio_available:
-               if config.heater_invert:
-                 GPIO.output(config.gpio_heat, GPIO.LOW)
-                 time.sleep(self.time_step * value)
-                 GPIO.output(config.gpio_heat, GPIO.HIGH)
-               else:
-                 GPIO.output(config.gpio_heat, GPIO.HIGH)
-                 time.sleep(self.time_step * value)
-                 GPIO.output(config.gpio_heat, GPIO.LOW)
-            else:
-                 #for runs that are simulations
-                 time.sleep(self.time_step * value)
         else:
             self.heat = 0.0
-            if gpio_available:
-               if config.heater_invert:
-                 GPIO.output(config.gpio_heat, GPIO.HIGH)
-               else:
-                 GPIO.output(config.gpio_heat, GPIO.LOW)
+        self.heater.set_duty(max(float(value), 0.))
+
+    def get_model(self):
+        '''a thermal model of this oven, for forecasts'''
+        return ThermalModel.from_file()
 
     def get_state(self):
         state = {
@@ -184,23 +211,29 @@ class Oven (threading.Thread):
             'target': self.target,
             'state': self.state,
             'heat': self.heat,
+            'pid': self.pid_output,
             'totaltime': self.totaltime,
+            'holding': self.holding,
+            'late_ticks': self.scheduler.late_ticks,
+            'skipped_ticks': self.scheduler.skipped,
         }
+        state.update(self.energy.get_state())
         return state
 
 
 class TempSensor(threading.Thread):
-    def __init__(self, time_step):
+    def __init__(self, time_step, clock=None):
         threading.Thread.__init__(self)
         self.daemon = True
         self.temperature = 0
         self.time_step = time_step
+        self.clock = clock or Clock()
         self.active = False
 
 
 class TempSensorReal(TempSensor):
-    def __init__(self, time_step):
-        TempSensor.__init__(self, time_step)
+    def __init__(self, time_step, clock=None):
+        TempSensor.__init__(self, time_step, clock=clock)
         if config.max6675:
             log.info("init MAX6675")
             self.thermocouple = MAX6675(config.gpio_sensor_cs,
@@ -234,112 +267,218 @@ class TempSensorReal(TempSensor):
                     maxtemp = temp
                 if x == 0 and self.active:
                     requests.post(config.led_controller, json={config.temperature_led: (225, 0, 0)})
-                time.sleep(sleeptime)
+                self.clock.sleep(sleeptime)
                 if x == 0 and self.active:
                     requests.post(config.led_controller, json={config.temperature_led: (0, 0, 0)})
             self.temperature = maxtemp
 
 
+class ThermalModel():
+    '''
+    Lumped two node model of the oven: the heating element and the oven
+    chamber, losing heat to the environment.
+    Temperatures are in deg C, time in seconds. forecast.from_model and
+    to_model convert to and from the temp_scale of config.py.
+    '''
+    PARAMETERS = ('t_env', 'c_heat', 'c_oven', 'p_heat', 'R_o', 'R_ho')
+
+    def __init__(self,
+                 t_env=config.sim_t_env,
+                 c_heat=config.sim_c_heat,
+                 c_oven=config.sim_c_oven,
+                 p_heat=config.sim_p_heat,
+                 R_o=config.sim_R_o_nocool,
+                 R_ho=config.sim_R_ho_noair,
+                 temperature=None):
+        self.t_env = t_env
+        self.c_heat = c_heat
+        self.c_oven = c_oven
+        self.p_heat = p_heat
+        self.R_o = R_o
+        self.R_ho = R_ho
+        self.reset(temperature)
+
+    @classmethod
+    def from_file(cls, path=config.thermal_model_path):
+        '''
+        the model fitted to the firings of this kiln by kiln-fit-model.py,
+        or the sim_* parameters of config.py if there is none
+        '''
+        try:
+            with open(path, 'r') as f:
+                model = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError) as ex:
+            log.warning("could not load the thermal model %s: %s" % (path, ex))
+            return cls()
+        return cls(**{name: model[name] for name in cls.PARAMETERS if name in model})
+
+    def parameters(self):
+        return {name: getattr(self, name) for name in self.PARAMETERS}
+
+    def reset(self, temperature=None, element_temperature=None):
+        if temperature is None:
+            temperature = self.t_env
+        if element_temperature is None:
+            element_temperature = temperature
+        self.t = temperature      # deg C  temp in oven
+        self.t_h = element_temperature  # deg C temp of heat element
+        self.p_ho = 0.
+        self.p_env = 0.
+
+    def step(self, dt, duty):
+        '''advance the model by dt seconds with the heater on for duty (0-1)'''
+        #heating energy
+        Q_h = self.p_heat * dt * duty
+
+        #temperature change of heat element by heating
+        self.t_h += Q_h / self.c_heat
+
+        #energy flux heat_el -> oven
+        self.p_ho = (self.t_h - self.t) / self.R_ho
+
+        #temperature change of oven and heat el
+        self.t += self.p_ho * dt / self.c_oven
+        self.t_h -= self.p_ho * dt / self.c_heat
+
+        #temperature change of oven by cooling to env
+        self.p_env = (self.t - self.t_env) / self.R_o
+        self.t -= self.p_env * dt / self.c_oven
+        return self.t
+
+
 class TempSensorSimulate(TempSensor):
-    def __init__(self, oven, time_step, sleep_time):
-        TempSensor.__init__(self, time_step)
+    def __init__(self, oven, time_step, sleep_time, clock=None):
+        TempSensor.__init__(self, time_step, clock=clock)
         self.oven = oven
         self.sleep_time = sleep_time
         self.active = False
+        self.model = ThermalModel.from_file()
 
     def run(self):
-        t_env      = config.sim_t_env
-        c_heat     = config.sim_c_heat
-        c_oven     = config.sim_c_oven
-        p_heat     = config.sim_p_heat
-        R_o_nocool = config.sim_R_o_nocool
-        R_ho_noair = config.sim_R_ho_noair
-        R_ho = R_ho_noair
-
-        t = t_env  # deg C  temp in oven
-        t_h = t    # deg C temp of heat element
         while True:
-            #heating energy
-            Q_h = p_heat * self.time_step * self.oven.heat
-
-            #temperature change of heat element by heating
-            t_h += Q_h / c_heat
-
-            #energy flux heat_el -> oven
-            p_ho = (t_h - t) / R_ho
-
-            #temperature change of oven and heat el
-            t   += p_ho * self.time_step / c_oven
-            t_h -= p_ho * self.time_step / c_heat
-
-            #temperature change of oven by cooling to env
-            p_env = (t - t_env) / R_o_nocool
-            t -= p_env * self.time_step / c_oven
-            log.debug("energy sim: -> %dW heater: %.0f -> %dW oven: %.0f -> %dW env" % (int(p_heat * self.oven.heat), t_h, int(p_ho), t, int(p_env)))
-            self.temperature = t
+            duty = self.oven.heater.duty
+            t = self.model.step(self.time_step, duty)
+            log.debug("energy sim: -> %dW heater: %.0f -> %dW oven: %.0f -> %dW env" % (int(self.model.p_heat * duty), self.model.t_h, int(self.model.p_ho), t, int(self.model.p_env)))
+            # the model is in deg C, the sensor in the display scale:
+            self.temperature = from_model(t)
 
             if self.active and gpio_available:
                 requests.post(config.led_controller, json={config.temperature_led: (225, 0, 0)})
-            time.sleep(self.sleep_time / 2)
+            self.clock.sleep(self.sleep_time / 2)
             if self.active and gpio_available:
                 requests.post(config.led_controller, json={config.temperature_led: (0, 0, 0)})
-            time.sleep(self.sleep_time / 2)
+            self.clock.sleep(self.sleep_time / 2)
 
 
 class Profile():
     def __init__(self, json_data):
-        obj = json.loads(json_data)
+        self._load(json.loads(json_data))
+
+    @classmethod
+    def from_dict(cls, obj):
+        '''profile from an already parsed profile object'''
+        profile = cls.__new__(cls)
+        profile._load(obj)
+        return profile
+
+    def _load(self, obj):
         self.name = obj["name"]
         self.data = sorted(obj["data"])
+        self.compile()
+
+    def __setstate__(self, state):
+        # profiles pickled before the lookup tables existed
+        self.__dict__.update(state)
+        self.compile()
+
+    def compile(self):
+        '''
+        build the lookup tables from self.data, call again if data changes
+        '''
+        self.times = [float(t) for (t, x) in self.data]
+        self.temperatures = [float(x) for (t, x) in self.data]
+        self.slopes = []
+        for i in range(len(self.data) - 1):
+            dt = self.times[i+1] - self.times[i]
+            if dt > 0:
+                self.slopes.append((self.temperatures[i+1] - self.temperatures[i]) / dt)
+            else:
+                self.slopes.append(0.)
+        self.duration = max(self.times) if self.times else 0
 
     def get_duration(self):
-        return max([t for (t, x) in self.data])
+        return self.duration
+
+    def get_segment(self, time, hint=None):
+        '''
+        index i of the segment from point i to point i+1 that contains time,
+        or None after the end of the profile. hint is the segment the caller
+        got last time: runtime mostly moves forward, so that segment and the
+        next are tried before a binary search. Callers keep their own hint,
+        profiles are shared by threads.
+        '''
+        if time > self.duration or len(self.times) < 2:
+            return None
+        times = self.times
+        last = len(times) - 2
+        if hint is not None and 0 <= hint <= last:
+            if times[hint] <= time < times[hint+1]:
+                return hint
+            if hint < last and times[hint+1] <= time < times[hint+2]:
+                return hint + 1
+        return min(max(bisect.bisect_right(times, time) - 1, 0), last)
 
     def get_surrounding_points(self, time):
-        if time > self.get_duration():
+        i = self.get_segment(time)
+        if i is None:
             return (None, None)
+        return (self.data[i], self.data[i+1])
 
-        prev_point = None
-        next_point = None
-
-        for i in range(len(self.data)):
-            if time < self.data[i][0]:
-                prev_point = self.data[i-1]
-                next_point = self.data[i]
-                break
-
-        return (prev_point, next_point)
+    def get_slope(self, time, hint=None):
+        '''slope of the profile at time in degrees per second'''
+        i = self.get_segment(time, hint)
+        if i is None:
+            return 0.
+        return self.slopes[i]
 
     def is_rising(self, time):
-        (prev_point, next_point) = self.get_surrounding_points(time)
-        if prev_point and next_point:
-            return prev_point[1] < next_point[1]
-        else:
-            return False
+        return self.get_slope(time) > 0
 
-    def get_target_temperature(self, time):
-        if time > self.get_duration():
+    def get_target_temperature(self, time, hint=None):
+        i = self.get_segment(time, hint)
+        if i is None:
             return 0
+        return self.temperatures[i] + (max(time, self.times[i]) - self.times[i]) * self.slopes[i]
 
-        (prev_point, next_point) = self.get_surrounding_points(time)
-
-        incl = float(next_point[1] - prev_point[1]) / float(next_point[0] - prev_point[0])
-        temp = prev_point[1] + (time - prev_point[0]) * incl
-        return temp
+    def targets(self, times):
+        '''target temperatures for an array of times'''
+        import numpy as np
+        times = np.asarray(times, dtype=float)
+        if len(self.times) < 2:
+            return np.zeros_like(times)
+        temps = np.interp(times, self.times, self.temperatures)
+        temps[times > self.duration] = 0.
+        return temps
 
 
 class PID():
-    def __init__(self, ki=1, kp=1, kd=1):
+    def __init__(self, ki=1, kp=1, kd=1, clock=None):
         self.ki = ki
         self.kp = kp
         self.kd = kd
-        self.lastNow = datetime.datetime.now()
+        self.clock = clock or Clock()
+        self.lastNow = self.clock.monotonic()
         self.iterm = 0
         self.lastErr = 0
+        self.lastOutput = 0
 
     def compute(self, setpoint, ispoint):
-        now = datetime.datetime.now()
-        timeDelta = (now - self.lastNow).total_seconds()
+        now = self.clock.monotonic()
+        timeDelta = now - self.lastNow
+        if timeDelta <= 0:
+            return self.lastOutput
 
         error = float(setpoint - ispoint)
         self.iterm += (error * timeDelta * self.ki)
@@ -350,5 +489,6 @@ class PID():
         output = sorted([-1, output, 1])[1]
         self.lastErr = error
         self.lastNow = now
+        self.lastOutput = output
 
         return output
@@ -1,90 +1,132 @@
-import threading,logging,json,time,datetime
+import threading,logging,datetime,uuid
+import config
 from oven import Oven
+from telemetry import TelemetryBuffer, backlog_points
+from rampEstimator import RampEstimator
+from forecast import Forecaster
+from broadcast import BroadcastHub, Frame
+import statusEncoding
 log = logging.getLogger(__name__)
 
 class OvenWatcher(threading.Thread):
-    def __init__(self,oven):
+    def __init__(self,oven,clock=None):
         self.last_profile = None
-        self.last_log = []
+        self.last_log = TelemetryBuffer()
         self.started = None
         self.recording = False
-        self.observers = []
+        self.observers = BroadcastHub()
+        # every status frame gets a sequence number, the epoch tells clients
+        # that reconnect whether the numbers are from this server run
+        self.seq = 0
+        self.run_seq = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+        self.ramp = RampEstimator()
         threading.Thread.__init__(self)
         self.daemon = True
         self.oven = oven
+        self.clock = clock or oven.clock
+        self.forecaster = Forecaster(oven, listener=self.publish_forecast, clock=self.clock)
         self.start()
 
-# FIXME - need to save runs of schedules in near-real-time
-# FIXME - this will enable re-start in case of power outage
-# FIXME - re-start also requires safety start (pausing at the beginning
-# until a temp is reached)
-# FIXME - re-start requires a time setting in minutes.  if power has been
-# out more than N minutes, don't restart
-# FIXME - this should not be done in the Watcher, but in the Oven class
-
     def run(self):
         while True:
             oven_state = self.oven.get_state()
+            with self.lock:
+                self.seq += 1
+                oven_state['seq'] = self.seq
+                self.ramp.update(self.clock.monotonic(), oven_state['temperature'])
+                oven_state.update(self.ramp.get_state(self.target_slope(oven_state)))
+                oven_state.update(self.forecaster.get_state())
+                # record state for any new clients that join
+                if oven_state.get("state") == Oven.STATE_RUNNING:
+                    self.last_log.append(oven_state)
+                else:
+                    self.recording = False
+                self.notify_all(oven_state)
+            self.clock.sleep(self.oven.time_step)
 
-            # record state for any new clients that join
-            if oven_state.get("state") == Oven.STATE_RUNNING:
-                self.last_log.append(oven_state)
-            else:
-                self.recording = False
-            self.notify_all(oven_state)
-            time.sleep(self.oven.time_step)
+    def target_slope(self, oven_state):
+        '''slope of the schedule in degrees per second, None when not firing'''
+        profile = self.oven.profile
+        if oven_state.get("state") != Oven.STATE_RUNNING or profile is None:
+            return None
+        if oven_state.get("holding"):
+            return 0.
+        return profile.get_slope(oven_state['runtime'])
 
-    def lastlog_subset(self,maxpts=50):
-        '''send about maxpts from lastlog by skipping unwanted data'''
-        totalpts = len(self.last_log)
-        if (totalpts <= maxpts):
-            return self.last_log
-        every_nth = int(totalpts / (maxpts - 1))
-        return self.last_log[::every_nth]
+    def publish_forecast(self, forecast):
+        '''send a new forecast, with the segments that lag, to the clients'''
+        self.notify_all({'type': "forecast", 'forecast': forecast}, Frame.OTHER)
 
-    def record(self, profile):
-        self.last_profile = profile
-        self.last_log = []
-        self.started = datetime.datetime.now()
-        self.recording = True
-        #we just turned on, add first state for nice graph
-        self.last_log.append(self.oven.get_state())
+    def lastlog_subset(self,maxpts=config.status_backlog_points):
+        '''send at most maxpts from lastlog, keeping peaks and holds'''
+        maxpts = min(maxpts, config.status_backlog_max_points)
+        return self.last_log.subset(backlog_points(maxpts))
 
-    def add_observer(self,observer):
-        if self.last_profile:
-            p = {
-                "name": self.last_profile.name,
-                "data": self.last_profile.data,
-                "type" : "profile"
-            }
-        else:
-            p = None
-
-        backlog = {
-            'type': "backlog",
-            'profile': p,
-            'log': self.lastlog_subset(),
-            #'started': self.started
-        }
-        print (backlog)
-        backlog_json = json.dumps(backlog)
-        try:
-            print (backlog_json)
-            observer.send(backlog_json)
-        except:
-            log.error("Could not send backlog to new observer")
+    def record(self, profile, samples=(), started=None):
+        '''
+        start recording a firing. A resumed firing passes the samples of its
+        journal and the timestamp it started at, so that it is kept whole.
+        '''
+        with self.lock:
+            self.last_profile = profile
+            self.last_log = TelemetryBuffer()
+            self.started = datetime.datetime.fromtimestamp(started) if started is not None else self.clock.now()
+            self.recording = True
+            self.run_seq = self.seq + 1
+            for sample in samples:
+                self.seq += 1
+                self.last_log.append(dict(sample, seq=self.seq))
+            #we just turned on, add first state for nice graph
+            self.seq += 1
+            oven_state = self.oven.get_state()
+            oven_state['seq'] = self.seq
+            self.last_log.append(oven_state)
 
-        self.observers.append(observer)
+    def add_observer(self,observer,maxpts=config.status_backlog_points,since=None,epoch=None,format=None):
+        '''
+        register a client, sending it the backlog of the current firing.
+        A client that reconnects can pass the last sequence number and epoch
+        it received to only get the samples it missed. format selects the
+        wire format, see statusEncoding.
+        '''
+        encoder = statusEncoding.get_encoder(format)
+        maxpts = min(maxpts, config.status_backlog_max_points)
+        with self.lock:
+            missed = None
+            if since is not None and epoch == self.epoch and since >= self.run_seq:
+                missed = self.last_log.since(since, maxpts)
+            if missed is not None:
+                self.observers.add(observer, Frame({
+                    'type': "resume",
+                    'log': missed,
+                    'seq': self.seq,
+                    'epoch': self.epoch,
+                }), encoder)
+                return
 
-    def notify_all(self,message):
-        message_json = json.dumps(message)
-        log.debug("sending to %d clients: %s"%(len(self.observers),message_json))
-        for wsock in self.observers:
-            if wsock:
-                try:
-                    wsock.send(message_json)
-                except:
-                    log.error("could not write to socket %s"%wsock)
-                    self.observers.remove(wsock)
+            if self.last_profile:
+                p = {
+                    "name": self.last_profile.name,
+                    "data": self.last_profile.data,
+                    "type" : "profile"
+                }
             else:
-                self.observers.remove(wsock)
+                p = None
+
+            backlog = {
+                'type': "backlog",
+                'profile': p,
+                'log': self.lastlog_subset(maxpts),
+                'forecast': self.forecaster.forecast,
+                'seq': self.seq,
+                'epoch': self.epoch,
+            }
+            self.observers.add(observer, Frame(backlog), encoder)
+
+    def remove_observer(self,observer):
+        self.observers.remove(observer)
+
+    def notify_all(self,message,kind=Frame.STATUS):
+        self.observers.broadcast(message,kind)
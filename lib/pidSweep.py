@@ -0,0 +1,108 @@
+"""
+Vectorized batch simulation of firings for PID parameter sweeps.
+
+Every combination of PID gains and thermal model parameters is one column
+of the state arrays, so thousands of simulated ovens are stepped at once
+against the same profile with the same math as PID and ThermalModel.
+"""
+import logging
+
+import numpy as np
+
+import config
+from oven import ThermalModel
+from forecast import from_model
+
+log = logging.getLogger(__name__)
+
+
+def simulate_batch(profile, kp=config.pid_kp, ki=config.pid_ki, kd=config.pid_kd,
+                   t_env=None, c_heat=None, c_oven=None, p_heat=None, R_o=None, R_ho=None,
+                   model=None, time_step=config.sensor_time_wait):
+    """
+    Simulate the profile for every combination of the (broadcastable) PID
+    and model parameters. Model parameters that are not given are those of
+    model, a ThermalModel, by default the one fitted by kiln-fit-model.py
+    or, if there is none, the sim_* parameters of config.py.
+
+    Returns a dictionary of arrays, one entry per combination:
+    - overshoot: maximum temperature above target
+    - rms_error: root mean square tracking error
+    - max_lag: maximum temperature below target
+    - energy: energy used by the heater in kWh
+    together with the flattened parameters.
+    """
+    given = (t_env, c_heat, c_oven, p_heat, R_o, R_ho)
+    if any(value is None for value in given):
+        defaults = (model or ThermalModel.from_file()).parameters()
+        given = [defaults[name] if value is None else value
+                 for name, value in zip(ThermalModel.PARAMETERS, given)]
+    params = np.broadcast_arrays(*[np.atleast_1d(np.asarray(p, dtype=float)).ravel()
+                                   for p in (kp, ki, kd) + tuple(given)])
+    kp, ki, kd, t_env, c_heat, c_oven, p_heat, R_o, R_ho = params
+    num = len(kp)
+    dt = float(time_step)
+
+    # state of the ovens and of the controllers:
+    t = t_env.copy()
+    t_h = t_env.copy()
+    iterm = np.zeros(num)
+    last_err = np.zeros(num)
+
+    # running results:
+    overshoot = np.zeros(num)
+    max_lag = np.zeros(num)
+    sq_error = np.zeros(num)
+    on_time = np.zeros(num)
+
+    totaltime = profile.get_duration()
+    num_steps = max(int(np.ceil(totaltime / dt)), 0)
+    targets = profile.targets(np.arange(num_steps) * dt)
+    for target in targets:
+        # the model is in deg C, the profile in the display scale:
+        measured = from_model(t) + config.thermocouple_offset
+
+        # PID, same as PID.compute:
+        error = target - measured
+        iterm = np.clip(iterm + error * dt * ki, -1., 1.)
+        output = np.clip(kp * error + iterm + kd * (error - last_err) / dt, -1., 1.)
+        last_err = error
+        duty = np.maximum(output, 0.)
+
+        # tracking statistics:
+        np.maximum(overshoot, -error, out=overshoot)
+        np.maximum(max_lag, error, out=max_lag)
+        sq_error += error**2
+        on_time += duty * dt
+
+        # thermal model, same as ThermalModel.step:
+        t_h += p_heat * dt * duty / c_heat
+        p_ho = (t_h - t) / R_ho
+        t += p_ho * dt / c_oven
+        t_h -= p_ho * dt / c_heat
+        t -= (t - t_env) / R_o * dt / c_oven
+
+    return {
+        'kp': kp, 'ki': ki, 'kd': kd,
+        't_env': t_env, 'c_heat': c_heat, 'c_oven': c_oven,
+        'p_heat': p_heat, 'R_o': R_o, 'R_ho': R_ho,
+        'overshoot': overshoot,
+        'rms_error': np.sqrt(sq_error / max(num_steps, 1)),
+        'max_lag': max_lag,
+        'energy': p_heat * on_time / 3.6e6,
+    }
+
+
+def sweep(profile, kp, ki, kd, **kwargs):
+    """
+    Simulate the full grid of the given kp, ki and kd values.
+    Extra keyword arguments are passed to simulate_batch and can themselves
+    be arrays of the size of the grid or scalars.
+    """
+    grid = np.meshgrid(np.atleast_1d(kp), np.atleast_1d(ki), np.atleast_1d(kd), indexing='ij')
+    return simulate_batch(profile, kp=grid[0].ravel(), ki=grid[1].ravel(), kd=grid[2].ravel(), **kwargs)
+
+
+def best(results, metric='rms_error', num=10):
+    """indexes of the num best combinations according to metric"""
+    return np.argsort(results[metric])[:num]
@@ -0,0 +1,109 @@
+"""
+Plots of the firings of the history, rendered on demand and cached.
+
+A plot is rendered once per record, kind, format and options and kept in
+the plot cache, whose file names are a hash of all of them and of the size
+and modification time of the record. Looking a plot up does not import
+matplotlib, rendering is meant to run in the report worker.
+"""
+import os
+import json
+import hashlib
+import logging
+
+import config
+from . import history
+
+log = logging.getLogger(__name__)
+
+KINDS = ('full', 'peak', 'ramp')
+FORMATS = {
+    'png': "image/png",
+    'svg': "image/svg+xml",
+    'pdf': "application/pdf",
+}
+OPTIONS = {
+    'smoothing_scale': config.smoothing_scale,
+    'unload_temperature': config.unload_temperature,
+    'peak_zoom': config.peak_zoom,
+    'dpi': 100,
+}
+# bump when the plots change, so that cached plots are rendered again
+PLOT_VERSION = 1
+
+
+def plot_options(options=None):
+    '''the options of a plot, with the defaults for the missing ones'''
+    merged = dict(OPTIONS)
+    for name, value in (options or {}).items():
+        if name in OPTIONS:
+            merged[name] = float(value)
+    return merged
+
+
+def cache_name(record_path, run, kind, format, options):
+    if kind not in KINDS:
+        raise ValueError("unknown plot %s" % kind)
+    if format not in FORMATS:
+        raise ValueError("unknown plot format %s" % format)
+    stat = os.stat(record_path)
+    key = json.dumps([PLOT_VERSION, run, stat.st_size, stat.st_mtime_ns, kind, sorted(options.items())])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return "%s-%s-%s.%s" % (run, kind, digest, format)
+
+
+def _record_path(history_path, run):
+    return os.path.join(history_path, os.path.basename(run) + history.EXTENSION)
+
+
+def cached_plot(history_path, cache_path, run, kind, format='png', options=None):
+    '''path of the plot if it is in the cache, otherwise None'''
+    options = plot_options(options)
+    path = os.path.join(cache_path, cache_name(_record_path(history_path, run), run, kind, format, options))
+    if not os.path.exists(path):
+        return None
+    # the cache is pruned by age of last use:
+    os.utime(path)
+    return path
+
+
+def _prune(cache_path, max_files=config.plot_cache_files):
+    entries = [entry for entry in os.scandir(cache_path) if not entry.name.startswith('.')]
+    if len(entries) <= max_files:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:len(entries) - max_files]:
+        log.debug("removing %s from the plot cache" % entry.name)
+        os.remove(entry.path)
+
+
+def render_plot(history_path, cache_path, run, kind, format='png', options=None, data=None):
+    '''
+    path of the plot, rendered in the cache if needed. data, as returned
+    by analysis.prepare, saves preparing the record again.
+    '''
+    options = plot_options(options)
+    record_path = _record_path(history_path, run)
+    name = cache_name(record_path, run, kind, format, options)
+    path = os.path.join(cache_path, name)
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+
+    from . import analysis
+    record = history.HistoryRecord(record_path)
+    if data is None:
+        data = analysis.prepare(record.column('runtime'), record.column('temperature'), options)
+    log.info("rendering %s" % name)
+    os.makedirs(cache_path, exist_ok=True)
+    tmp_path = os.path.join(cache_path, '.tmp-' + name)
+    dpi = options['dpi']
+    if kind == 'full':
+        analysis.plot_full(data, record.started, tmp_path, dpi=dpi)
+    elif kind == 'peak':
+        analysis.plot_peak(data, record.started, tmp_path, options['peak_zoom'], dpi=dpi, always=True)
+    else:
+        analysis.plot_ramp(data, record.started, tmp_path, dpi=dpi)
+    os.replace(tmp_path, path)
+    _prune(cache_path)
+    return path
@@ -0,0 +1,178 @@
+import os
+import json
+import uuid
+import threading
+import collections
+import logging
+
+import config
+
+log = logging.getLogger(__name__)
+
+
+class ProfileStore():
+    '''
+    Profiles of a directory, kept in memory.
+
+    The parsed profiles are indexed by name, compiled Profile objects are
+    built once per profile and the list sent to the clients is encoded
+    once. The cache is reloaded when the modification time of the directory
+    changes, which happens whenever a profile is added, removed or replaced,
+    and after every write of the store itself. Profiles are written to a
+    temporary file and renamed, so a reader never sees half a profile.
+
+    Every change of the profiles makes a new version. The last changes are
+    kept so that a client that knows a version can be sent only what
+    changed since, and listener(delta) is called with every change.
+    '''
+    def __init__(self, path, profile_class, history_length=config.profile_history_length):
+        self.path = path
+        self.profile_class = profile_class
+        self.lock = threading.Lock()
+        self.dir_mtime = None
+        self.profiles = {}
+        self.compiled = {}
+        self.payload = "[]"
+        # versions are only meaningful within one server run
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.changes = collections.deque(maxlen=history_length)
+        self.listener = None
+
+    def _filepath(self, name):
+        return os.path.join(self.path, name + ".json")
+
+    def _refresh(self):
+        try:
+            dir_mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        if dir_mtime is not None and dir_mtime == self.dir_mtime:
+            return
+        profiles = {}
+        try:
+            filenames = sorted(os.listdir(self.path))
+        except OSError:
+            filenames = []
+        for filename in filenames:
+            if filename.startswith('.') or filename.endswith('.tmp'):
+                continue
+            try:
+                with open(os.path.join(self.path, filename), 'r') as f:
+                    profile = json.load(f)
+            except (OSError, ValueError) as ex:
+                log.error("could not read profile %s: %s" % (filename, ex))
+                continue
+            profiles[profile['name']] = profile
+        self.dir_mtime = dir_mtime
+        changed = [name for name, profile in profiles.items() if self.profiles.get(name) != profile]
+        removed = [name for name in self.profiles if name not in profiles]
+        if not changed and not removed and self.version > 0:
+            return
+        for name in changed + removed:
+            self.compiled.pop(name, None)
+        self.profiles = profiles
+        self.payload = json.dumps(list(profiles.values()))
+        self.version += 1
+        self.changes.append((self.version, changed, removed))
+        log.info("loaded %d profiles from %s, version %s" % (len(profiles), self.path, self.etag()))
+        if self.listener is not None and self.version > 1:
+            self.listener(self._delta(self.version - 1))
+
+    def etag(self):
+        return "%s-%d" % (self.epoch, self.version)
+
+    def _delta(self, version):
+        '''
+        the profiles changed and removed after version, None if unknown.
+        base is the version the changes apply to.
+        '''
+        if not self.changes or self.changes[0][0] > version + 1:
+            return None
+        changed, removed = set(), set()
+        for number, names, gone in self.changes:
+            if number <= version:
+                continue
+            changed.update(names)
+            changed.difference_update(gone)
+            removed.difference_update(names)
+            removed.update(gone)
+        return {
+            'type': "profiles",
+            'base': "%s-%d" % (self.epoch, version),
+            'version': self.etag(),
+            'changed': [self.profiles[name] for name in sorted(changed)],
+            'removed': sorted(removed),
+        }
+
+    def sync_json(self, etag=None):
+        '''
+        what a client at version etag needs to be up to date, as JSON:
+        nothing, the changes since its version or all the profiles
+        '''
+        with self.lock:
+            self._refresh()
+            if etag == self.etag():
+                return json.dumps({'type': "profiles", 'version': etag, 'unchanged': True})
+            if etag is not None and etag.startswith(self.epoch + '-') and etag[len(self.epoch) + 1:].isdigit():
+                delta = self._delta(int(etag[len(self.epoch) + 1:]))
+                if delta is not None:
+                    return json.dumps(delta)
+            return '{"type": "profiles", "version": "%s", "profiles": %s}' % (self.etag(), self.payload)
+
+    def invalidate(self):
+        with self.lock:
+            self.dir_mtime = None
+
+    def list_json(self):
+        '''the JSON list of all the profiles, as sent to the clients'''
+        with self.lock:
+            self._refresh()
+            return self.payload
+
+    def list(self):
+        with self.lock:
+            self._refresh()
+            return list(self.profiles.values())
+
+    def get(self, name):
+        '''the parsed profile called name, or None'''
+        with self.lock:
+            self._refresh()
+            return self.profiles.get(name)
+
+    def get_profile(self, name):
+        '''the compiled Profile called name, or None'''
+        with self.lock:
+            self._refresh()
+            profile = self.compiled.get(name)
+            if profile is None and name in self.profiles:
+                profile = self.profile_class.from_dict(self.profiles[name])
+                self.compiled[name] = profile
+            return profile
+
+    def save(self, profile, force=False):
+        filepath = self._filepath(profile['name'])
+        with self.lock:
+            if not force and os.path.exists(filepath):
+                log.error("Could not write, %s already exists" % filepath)
+                return False
+            tmp_path = filepath + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(profile, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, filepath)
+            self.dir_mtime = None
+            self._refresh()
+        log.info("Wrote %s" % filepath)
+        return True
+
+    def delete(self, profile):
+        filepath = self._filepath(profile['name'])
+        with self.lock:
+            os.remove(filepath)
+            self.dir_mtime = None
+            self._refresh()
+        log.info("Deleted %s" % filepath)
+        return True
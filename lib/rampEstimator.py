@@ -0,0 +1,71 @@
+import math
+import logging
+
+import config
+
+log = logging.getLogger(__name__)
+
+
+class RampEstimator():
+    '''
+    Causal estimate of the smoothed temperature and of the ramp rate, in
+    degrees per hour, updated in O(1) per sample.
+
+    This is an alpha-beta filter: the state is predicted with the current
+    rate, then corrected by a fraction of the prediction error. The gains
+    are those of a critically damped filter with the given smoothing time
+    (seconds) and are computed from the time since the previous sample, so
+    irregular sampling is fine. A gap longer than max_gap restarts it.
+    '''
+    def __init__(self, smoothing_time=config.ramp_smoothing_time, max_gap=config.ramp_max_gap):
+        if smoothing_time <= 0:
+            raise ValueError("smoothing_time must be positive")
+        self.smoothing_time = float(smoothing_time)
+        self.max_gap = max_gap
+        self.reset()
+
+    def reset(self):
+        self.time = None
+        self.temperature = None
+        self.rate = 0.  # degrees per second
+        self.samples = 0
+
+    def update(self, time, temperature):
+        '''add a sample taken at time (seconds, monotonic)'''
+        if self.time is not None and time <= self.time:
+            return
+        if self.time is None or time - self.time > self.max_gap:
+            self.reset()
+            self.time = time
+            self.temperature = float(temperature)
+            self.samples = 1
+            return
+        dt = time - self.time
+        theta = math.exp(-dt / self.smoothing_time)
+        alpha = 1. - theta * theta
+        beta = (1. - theta) ** 2
+        predicted = self.temperature + self.rate * dt
+        residual = temperature - predicted
+        self.temperature = predicted + alpha * residual
+        self.rate += beta * residual / dt
+        self.time = time
+        self.samples += 1
+
+    def get_state(self, target_slope=None):
+        '''
+        fields for a status frame. target_slope is the slope of the profile
+        in degrees per second, the ramp error is the rate minus that slope.
+        The rate is None until two samples were seen.
+        '''
+        if self.samples < 2:
+            rate = None
+        else:
+            rate = self.rate * 3600.
+        error = None
+        if rate is not None and target_slope is not None:
+            error = rate - target_slope * 3600.
+        return {
+            'temperature_smooth': self.temperature,
+            'ramp_rate': rate,
+            'ramp_error': error,
+        }
@@ -0,0 +1,135 @@
+import importlib
+import itertools
+import threading
+import logging
+import multiprocessing
+import concurrent.futures
+
+import config
+
+log = logging.getLogger(__name__)
+
+
+def _ready():
+    return True
+
+
+def _call(target, *args):
+    '''call target, given as "module:function" so the caller need not import it'''
+    module, function = target.split(':')
+    return getattr(importlib.import_module(module), function)(*args)
+
+
+def _import(modules):
+    for module in modules:
+        importlib.import_module(module)
+    return modules
+
+
+def warm_up(modules):
+    '''import modules in a background thread'''
+    def run():
+        for module in modules:
+            log.debug("warming up %s" % module)
+            importlib.import_module(module)
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+class ReportWorker():
+    '''
+    Runs the analysis and reports of finished firings in a worker process,
+    so that plotting and sending emails never stall the web server.
+
+    Jobs are queued with submit() and return at once. Every change of the
+    state of a job (queued, done, failed) is passed to listener(job), the
+    apps forward it to the status websocket.
+
+    Worker processes are forked, which is only safe before the oven and the
+    server start their threads: create the worker first thing and call
+    start(), which forks the processes right away.
+    '''
+    def __init__(self, max_workers=config.report_workers, max_jobs=config.report_jobs_kept):
+        context = multiprocessing.get_context('fork')
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def start(self):
+        '''fork the worker processes now'''
+        self.executor.submit(_ready).result()
+
+    def _notify(self, job):
+        if self.listener is not None:
+            try:
+                self.listener(dict(job))
+            except Exception:
+                log.exception("could not notify job %d" % job['id'])
+
+    def warm_up(self, modules):
+        '''import modules in the worker processes, without waiting'''
+        for i in range(self.executor._max_workers):
+            self.executor.submit(_import, modules)
+
+    def submit(self, kind, function, *args, callback=None):
+        '''
+        queue function(*args) in the worker, returns the job id. function
+        can be given as "module:function", it is then only imported by the
+        worker. callback(result) is called in this process when it is done.
+        '''
+        with self.lock:
+            job = {'type': "job", 'id': next(self.ids), 'kind': kind, 'state': "queued"}
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.pop(next(iter(self.jobs)))
+        log.info("queued %s job %d" % (kind, job['id']))
+        self._notify(job)
+        if isinstance(function, str):
+            future = self.executor.submit(_call, function, *args)
+        else:
+            future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda future: self._done(job, future, callback))
+        return job['id']
+
+    def _done(self, job, future, callback=None):
+        error = future.exception()
+        with self.lock:
+            if error is None:
+                job['state'] = "done"
+                job['result'] = future.result()
+            else:
+                job['state'] = "failed"
+                job['error'] = str(error)
+        if error is None:
+            log.info("%s job %d done" % (job['kind'], job['id']))
+            if callback is not None:
+                try:
+                    callback(job['result'])
+                except Exception:
+                    log.exception("callback of %s job %d failed" % (job['kind'], job['id']))
+        else:
+            log.error("%s job %d failed: %s" % (job['kind'], job['id'], error))
+        self._notify(job)
+
+    def call(self, function, *args):
+        '''
+        run function(*args) in the worker and return its result. Only the
+        calling greenlet waits, the web server keeps serving meanwhile.
+        '''
+        import gevent
+        if isinstance(function, str):
+            future = self.executor.submit(_call, function, *args)
+        else:
+            future = self.executor.submit(function, *args)
+        return gevent.get_hub().threadpool.apply(future.result)
+
+    def get_jobs(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
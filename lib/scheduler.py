@@ -0,0 +1,113 @@
+import logging
+
+from clock import Clock
+
+log = logging.getLogger(__name__)
+
+
+class Tick():
+    '''
+    timing information about one tick of a FixedRateScheduler
+    '''
+    def __init__(self, index, deadline, woke, overrun, jitter, skipped):
+        self.index = index        # number of the period this tick belongs to
+        self.deadline = deadline  # monotonic time the tick was due
+        self.woke = woke          # monotonic time the tick actually started
+        self.overrun = overrun    # seconds the previous tick ran past this deadline
+        self.jitter = jitter      # seconds between deadline and wake up
+        self.skipped = skipped    # number of periods dropped before this tick
+
+
+class FixedRateScheduler():
+    '''
+    Deadline based scheduler for periodic loops.
+
+    Deadlines are computed as start + n * period on a monotonic clock, so the
+    time spent doing work inside the loop is subtracted from the sleep and
+    the loop does not drift. When a tick runs late the policy decides what
+    happens to the periods that were missed:
+
+    - "catchup": run the missed ticks back to back until on schedule again
+    - "skip": drop the missed ticks and realign to the next deadline
+    '''
+    POLICY_CATCHUP = "catchup"
+    POLICY_SKIP = "skip"
+
+    def __init__(self, period, policy=POLICY_SKIP, clock=None):
+        if period <= 0:
+            raise ValueError("period must be positive")
+        if policy not in (self.POLICY_CATCHUP, self.POLICY_SKIP):
+            raise ValueError("unknown scheduler policy %s" % policy)
+        self.period = float(period)
+        self.policy = policy
+        self.clock = clock or Clock()
+        self.reset()
+
+    def reset(self):
+        '''restart the schedule with the first deadline now'''
+        self.start = self.clock.monotonic()
+        self.index = 0
+        self.last_tick = None
+        self.ticks = 0
+        self.skipped = 0
+        self.late_ticks = 0
+        self.max_overrun = 0.
+        self.max_jitter = 0.
+
+    def deadline(self, index=None):
+        if index is None:
+            index = self.index
+        return self.start + index * self.period
+
+    def wait(self):
+        '''
+        block until the next deadline and return the Tick describing it
+        '''
+        deadline = self.deadline()
+        now = self.clock.monotonic()
+        overrun = max(0., now - deadline)
+        if now < deadline:
+            self.clock.sleep(deadline - now)
+            now = self.clock.monotonic()
+
+        skipped = 0
+        if self.policy == self.POLICY_SKIP and overrun >= self.period:
+            # drop every period that is already entirely in the past:
+            skipped = int((now - deadline) // self.period)
+            self.index += skipped
+            deadline = self.deadline()
+
+        tick = Tick(index=self.index,
+                    deadline=deadline,
+                    woke=now,
+                    overrun=overrun,
+                    jitter=now - deadline,
+                    skipped=skipped)
+        self.index += 1
+
+        # statistics:
+        self.ticks += 1
+        self.skipped += skipped
+        if overrun > 0:
+            self.late_ticks += 1
+            if overrun >= self.period:
+                log.warning("control loop overrun by %.3fs, %d tick(s) skipped" % (overrun, skipped))
+        self.max_overrun = max(self.max_overrun, overrun)
+        self.max_jitter = max(self.max_jitter, abs(tick.jitter))
+        self.last_tick = tick
+        return tick
+
+    def elapsed(self):
+        '''seconds since the schedule was (re)started'''
+        return self.clock.monotonic() - self.start
+
+    def get_stats(self):
+        return {
+            'ticks': self.ticks,
+            'late_ticks': self.late_ticks,
+            'skipped': self.skipped,
+            'max_overrun': self.max_overrun,
+            'max_jitter': self.max_jitter,
+            'last_overrun': self.last_tick.overrun if self.last_tick else 0.,
+            'last_jitter': self.last_tick.jitter if self.last_tick else 0.,
+        }
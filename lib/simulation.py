@@ -0,0 +1,58 @@
+"""
+Headless simulation of a firing.
+
+Runs the same PID and thermal model used by the simulated oven on a
+virtual clock, in a single thread, so a whole schedule takes as long as
+the CPU needs instead of as long as the firing.
+"""
+import logging
+
+import numpy as np
+
+import config
+from clock import VirtualClock
+from oven import PID, ThermalModel
+from forecast import from_model
+
+log = logging.getLogger(__name__)
+
+
+def simulate_profile(profile, time_step=config.sensor_time_wait, startat=0,
+                     kp=config.pid_kp, ki=config.pid_ki, kd=config.pid_kd,
+                     model=None, clock=None):
+    """
+    Simulate a full firing of profile and return the trace as a dictionary
+    of arrays: runtime, temperature, element_temperature, target, pid, heat.
+    Temperatures are in the temp_scale of config.py, like the oven reports
+    them, the model runs in deg C.
+
+    startat is in minutes, like Oven.run_profile.
+    """
+    clock = clock or VirtualClock()
+    model = model or ThermalModel.from_file()
+    pid = PID(ki=ki, kd=kd, kp=kp, clock=clock)
+
+    totaltime = profile.get_duration()
+    runtime = startat * 60.
+    num_steps = max(int(np.ceil((totaltime - runtime) / time_step)), 0)
+
+    trace = {key: np.zeros(num_steps) for key in
+             ['runtime', 'temperature', 'element_temperature', 'target', 'pid', 'heat']}
+    segment = None
+    for i in range(num_steps):
+        clock.advance(time_step)
+        segment = profile.get_segment(runtime, segment)
+        target = profile.get_target_temperature(runtime, segment)
+        measured = from_model(model.t) + config.thermocouple_offset
+        output = pid.compute(target, measured)
+        duty = max(output, 0.)
+        trace['runtime'][i] = runtime
+        trace['temperature'][i] = measured
+        trace['element_temperature'][i] = from_model(model.t_h)
+        trace['target'][i] = target
+        trace['pid'][i] = output
+        trace['heat'][i] = duty
+        model.step(time_step, duty)
+        runtime += time_step
+
+    return trace
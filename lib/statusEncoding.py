@@ -0,0 +1,115 @@
+"""
+Wire formats of the /status websocket.
+
+"json" sends every state as it is. "compact" is negotiated with
+/status?format=compact and sends status frames as the fields that changed
+since the previous frame sent to that client, with short keys, fixed-point
+numbers and a delta encoded runtime. Backlogs are sent as columns.
+See docs/api.md for the layout.
+"""
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+FORMAT_JSON = "json"
+FORMAT_COMPACT = "compact"
+
+# field name -> (short key, fixed-point scale)
+COMPACT_FIELDS = {
+    'runtime': ('r', 10),
+    'temperature': ('T', 10),
+    'target': ('g', 10),
+    'heat': ('h', 1000),
+    'pid': ('p', 1000),
+    'totaltime': ('tt', 1),
+    'state': ('s', None),
+    'temperature_smooth': ('Ts', 10),
+    'ramp_rate': ('rr', 10),
+    'ramp_error': ('re', 10),
+    'energy': ('e', 1000),
+    'cost': ('c', 100),
+    'forecast_time_left': ('ft', 1),
+    'forecast_peak': ('fp', 10),
+}
+
+_MISSING = object()
+
+
+def _fixed(value, scale):
+    if scale is None or not isinstance(value, (int, float)):
+        return value
+    return int(round(value * scale))
+
+
+class JSONEncoder():
+    '''plain JSON, the frame is encoded once and shared by every client'''
+    def encode(self, frame):
+        return frame.encode()
+
+
+class CompactEncoder():
+    '''
+    compact encoding for one client, it remembers what was sent before so it
+    must encode the frames in the order they are sent
+    '''
+    def __init__(self):
+        self.last = {}
+        self.last_runtime = None
+
+    def encode(self, frame):
+        message = frame.message
+        if not isinstance(message, dict):
+            return frame.encode()
+        kind = message.get('type')
+        if kind in ("backlog", "resume"):
+            return json.dumps(self.encode_log(message), separators=(',', ':'))
+        if kind is not None:
+            return frame.encode()
+        return json.dumps(self.encode_status(message), separators=(',', ':'))
+
+    def encode_status(self, state):
+        out = {'t': 's'}
+        for name, value in state.items():
+            if name == 'seq':
+                out['q'] = value
+                continue
+            key, scale = COMPACT_FIELDS.get(name, (name, None))
+            value = _fixed(value, scale)
+            if name == 'runtime':
+                # delta from the previous frame, absolute for the first one
+                if self.last_runtime is None:
+                    out['r'] = value
+                elif value != self.last_runtime:
+                    out['dr'] = value - self.last_runtime
+                self.last_runtime = value
+                continue
+            if self.last.get(name, _MISSING) != value:
+                out[key] = value
+                self.last[name] = value
+        return out
+
+    def encode_log(self, message):
+        '''samples of a backlog or resume frame as columns'''
+        samples = message.get('log', [])
+        columns = {}
+        for name in ('runtime', 'temperature', 'target', 'heat', 'pid'):
+            key, scale = COMPACT_FIELDS[name]
+            columns[key] = [_fixed(sample.get(name, 0.), scale) for sample in samples]
+        runtime = columns.pop('r')
+        if runtime:
+            columns['r0'] = runtime[0]
+            columns['dr'] = [b - a for a, b in zip(runtime[:-1], runtime[1:])]
+        out = {name: value for name, value in message.items() if name not in ('log', 'type')}
+        out['t'] = 'b' if message['type'] == "backlog" else 'r'
+        out['cols'] = columns
+        return out
+
+
+def get_encoder(name):
+    if name is None or name == FORMAT_JSON:
+        return JSONEncoder()
+    if name == FORMAT_COMPACT:
+        return CompactEncoder()
+    log.warning("unknown status format %s, using json" % name)
+    return JSONEncoder()
@@ -0,0 +1,157 @@
+"""
+System identification: fit the thermal model of the oven to recorded firings.
+
+ThermalModel is a linear two node model, heating element and chamber, so
+it is discretized exactly (zero order hold on the heater duty) on a regular
+grid and split in its two modes. Each mode is a first order recursion run
+by scipy.signal.lfilter, which makes a simulation of a whole firing a few
+vectorized calls. The heat capacity of the chamber and the thermal
+resistances are fitted by least squares on the recorded temperatures.
+
+The chamber temperature only determines three combinations of the model
+parameters, so two are not fitted: the power of the elements, taken from
+config.element_power, and the heat capacity of the elements, kept from the
+current model (sim_c_heat by default). With them fixed, the others are
+those of the kiln; see script/system_id_check.py.
+"""
+import os
+import json
+import time
+import datetime
+import logging
+
+import numpy as np
+
+import config
+from . import history
+from forecast import to_model, from_model
+
+log = logging.getLogger(__name__)
+
+# fitted parameters of ThermalModel, the others are fixed
+FITTED = ('c_oven', 'R_o', 'R_ho')
+
+
+def resample(runtime, temperature, pid, time_step=config.system_id_time_step):
+    '''
+    heater duty and temperature (deg C, as in the model) on a grid of
+    time_step seconds. The duty of every grid interval is the average of
+    the duty over that interval: the PID output of a sample holds until the
+    next sample, a control cycle, which is much shorter than the grid.
+    '''
+    runtime = np.asarray(runtime, dtype=float)
+    steps = int((runtime[-1] - runtime[0]) // time_step)
+    grid = runtime[0] + np.arange(steps + 1) * time_step
+    held = np.clip(np.asarray(pid, dtype=float), 0., 1.)
+    on_time = np.concatenate([[0.], np.cumsum(held[:-1] * np.diff(runtime))])
+    duty = np.diff(np.interp(grid, runtime, on_time)) / time_step
+    temperature = to_model(np.interp(grid[:-1], runtime, temperature) - config.thermocouple_offset)
+    return duty, temperature
+
+
+def load_run(path, time_step=config.system_id_time_step):
+    '''heater duty and temperature of a history record, see resample'''
+    record = history.HistoryRecord(path)
+    runtime = record.column('runtime')
+    if len(runtime) < 2 or runtime[-1] - runtime[0] < 10 * time_step:
+        raise ValueError("%s is too short to fit" % path)
+    duty, temperature = resample(runtime, record.column('temperature'), record.column('pid'), time_step)
+    return {'name': os.path.basename(path), 'duty': duty, 'temperature': temperature}
+
+
+def simulate(params, duty, t0, time_step=config.system_id_time_step):
+    '''
+    chamber temperature of the model with params (a dictionary with the
+    ThermalModel parameters) for the duty on the regular grid, starting at
+    rest at t0 deg C
+    '''
+    from scipy.signal import lfilter
+    c_heat, c_oven, R_o, R_ho = (params[name] for name in ('c_heat', 'c_oven', 'R_o', 'R_ho'))
+    # d/dt (t_h, t) - t_env = A ((t_h, t) - t_env) + B duty
+    A = np.array([[-1. / (R_ho * c_heat), 1. / (R_ho * c_heat)],
+                  [1. / (R_ho * c_oven), -(1. / R_ho + 1. / R_o) / c_oven]])
+    B = np.array([params['p_heat'] / c_heat, 0.])
+    rates, V = np.linalg.eig(A)
+    rates, V = rates.real, V.real
+    W = np.linalg.inv(V)
+    decay = np.exp(rates * time_step)
+    # zero order hold of the duty, per mode:
+    gain = (decay - 1.) / rates * (W @ B)
+    start = W @ np.full(2, t0 - params['t_env'])
+    out = np.full(len(duty), params['t_env'])
+    for m in range(2):
+        # mode[k+1] = decay * mode[k] + gain * duty[k], mode[0] = start
+        mode = lfilter([0., gain[m]], [1., -decay[m]], duty, zi=[start[m]])[0]
+        out += V[1, m] * mode
+    return out
+
+
+def fit(runs, initial=None, time_step=config.system_id_time_step, max_factor=1000.):
+    '''
+    least squares fit of the model to the runs returned by load_run.
+    initial has the starting ThermalModel parameters, the fixed ones are
+    kept. Returns the parameters and a report of the residuals.
+    '''
+    from scipy.optimize import least_squares
+    params = dict(initial or {})
+
+    def residuals(x):
+        trial = dict(params, **dict(zip(FITTED, np.exp(x))))
+        return np.concatenate([simulate(trial, run['duty'], run['temperature'][0], time_step) - run['temperature']
+                               for run in runs])
+
+    t0 = time.perf_counter()
+    # in logs, so that the parameters stay positive, within a factor of
+    # max_factor of the initial ones:
+    x0 = np.log([params[name] for name in FITTED])
+    result = least_squares(residuals, x0, bounds=(x0 - np.log(max_factor), x0 + np.log(max_factor)))
+    params.update(zip(FITTED, (float(value) for value in np.exp(result.x))))
+    elapsed = time.perf_counter() - t0
+
+    report = {'runs': [], 'samples': 0, 'evaluations': int(result.nfev), 'seconds': elapsed,
+              'converged': bool(result.success)}
+    squares = 0.
+    for run in runs:
+        # residuals in the degrees of the display scale:
+        error = from_model(simulate(params, run['duty'], run['temperature'][0], time_step)) - from_model(run['temperature'])
+        squares += float(np.sum(error**2))
+        report['samples'] += len(error)
+        report['runs'].append({'name': run['name'], 'rms': float(np.sqrt(np.mean(error**2))),
+                               'max': float(np.amax(np.abs(error)))})
+    report['rms'] = float(np.sqrt(squares / max(report['samples'], 1)))
+    return params, report
+
+
+def fit_records(paths, out_path=config.thermal_model_path, time_step=config.system_id_time_step):
+    '''
+    fit the model to the history records and write it to out_path, where
+    ThermalModel.from_file finds it. Returns what was written.
+    '''
+    from oven import ThermalModel
+    runs = [load_run(path, time_step) for path in paths]
+    initial = ThermalModel.from_file(out_path).parameters()
+    initial['p_heat'] = config.element_power
+    params, report = fit(runs, initial, time_step)
+    log.info("thermal model fitted to %d runs, rms residual %.1f deg" % (len(runs), report['rms']))
+    model = dict(params)
+    model.update({'version': 1, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'time_step': time_step, 'fit': report})
+    directory = os.path.dirname(out_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(model, f, indent=2)
+    os.replace(tmp_path, out_path)
+    return model
+
+
+def fit_history(history_path, runs=None, out_path=config.thermal_model_path):
+    '''fit_records on the named runs of the history, all of them by default'''
+    if not runs:
+        runs = sorted(name[:-len(history.EXTENSION)] for name in os.listdir(history_path)
+                      if name.endswith(history.EXTENSION))
+    if not runs:
+        raise ValueError("no firings in %s" % history_path)
+    paths = [os.path.join(history_path, os.path.basename(run) + history.EXTENSION) for run in runs]
+    return fit_records(paths, out_path)
@@ -0,0 +1,189 @@
+import logging
+import threading
+import bisect
+from array import array
+
+import config
+from downsample import MinMaxDownsampler
+
+log = logging.getLogger(__name__)
+
+
+def backlog_points(maxpts, levels=config.status_backlog_levels):
+    '''
+    round a point budget up to the next of levels, the budgets that are
+    kept up to date, at most the largest of them
+    '''
+    for level in levels:
+        if maxpts <= level:
+            return level
+    return levels[-1]
+
+
+class TelemetryBuffer():
+    '''
+    Columnar store for the states recorded during a firing.
+
+    Every column is a preallocated array of doubles that doubles in size
+    when full, so appending is amortized O(1) and a firing takes 8 bytes
+    per column per sample instead of a dictionary per sample.
+
+    With a capacity the buffer never holds more than capacity rows: when it
+    is exceeded the oldest half of the rows is thinned out by two. Repeated
+    thinning leaves the older part of the firing at progressively lower
+    resolution while the recent part stays at full resolution.
+
+    Downsampled views for clients are kept up to date as samples arrive,
+    one per requested point budget, see subset().
+    '''
+    COLUMNS = ('seq', 'runtime', 'temperature', 'target', 'heat', 'pid')
+
+    def __init__(self, capacity=config.telemetry_capacity, size=1024):
+        if capacity is not None and capacity < 4:
+            raise ValueError("capacity must be at least 4 rows")
+        self.capacity = capacity
+        self.thinned = 0  # leading rows that are not at full resolution
+        self._len = 0
+        self._columns = {name: self._allocate(size) for name in self.COLUMNS}
+        self._downsamplers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _allocate(size):
+        return array('d', bytes(8 * size))
+
+    @classmethod
+    def from_records(cls, records, **kwargs):
+        '''build a buffer from a list of state dictionaries'''
+        buffer = cls(**kwargs)
+        for state in records:
+            buffer.append(state)
+        return buffer
+
+    @classmethod
+    def from_columns(cls, columns, **kwargs):
+        '''build a buffer from a dictionary of equally long columns'''
+        import numpy as np
+        length = len(columns[cls.COLUMNS[1]])
+        buffer = cls(size=max(length, 1), **kwargs)
+        for name in cls.COLUMNS:
+            if name in columns:
+                data = np.ascontiguousarray(columns[name][0:length], dtype=np.float64)
+                buffer._columns[name][0:length] = array('d', data.tobytes())
+        buffer._len = length
+        return buffer
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_downsamplers'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._len
+
+    def _resize(self, size):
+        # new arrays are allocated, so views handed out before stay valid
+        for name, column in self._columns.items():
+            new = self._allocate(size)
+            new[0:self._len] = column[0:self._len]
+            self._columns[name] = new
+
+    def _thin(self):
+        half = self._len // 2
+        keep = (half + 1) // 2
+        size = len(self._columns[self.COLUMNS[0]])
+        for name, column in self._columns.items():
+            new = self._allocate(size)
+            new[0:keep] = column[0:half:2]
+            new[keep:self._len - half + keep] = column[half:self._len]
+            self._columns[name] = new
+        self._len = self._len - half + keep
+        self.thinned = keep
+
+    def append(self, state):
+        with self._lock:
+            if self._len == len(self._columns[self.COLUMNS[0]]):
+                self._resize(2 * self._len)
+            row = self._len
+            for name in self.COLUMNS:
+                self._columns[name][row] = float(state.get(name) or 0.)
+            self._len += 1
+            if self._downsamplers:
+                sample = self.row(row)
+                for downsampler in self._downsamplers.values():
+                    downsampler.add(sample)
+            if self.capacity is not None and self._len > self.capacity:
+                self._thin()
+
+    def clear(self):
+        with self._lock:
+            self._len = 0
+            self.thinned = 0
+            self._downsamplers = {}
+
+    def subset(self, maxpts):
+        '''
+        at most maxpts samples that keep the shape of the temperature curve.
+        The first request for a budget scans the buffer, after that the
+        result is maintained as samples are appended.
+        '''
+        maxpts = max(int(maxpts), 10)
+        with self._lock:
+            if self._len <= maxpts:
+                return self.records()
+            downsampler = self._downsamplers.get(maxpts)
+            if downsampler is None:
+                if len(self._downsamplers) >= config.telemetry_max_subsets:
+                    self._downsamplers.pop(next(iter(self._downsamplers)))
+                downsampler = MinMaxDownsampler(maxpts)
+                for i in range(self._len):
+                    downsampler.add(self.row(i))
+                self._downsamplers[maxpts] = downsampler
+            return list(downsampler.points())
+
+    def since(self, seq, maxpts=None):
+        '''
+        the samples recorded after sequence number seq, or None when some of
+        them are no longer available at full resolution (or there are more
+        than maxpts of them)
+        '''
+        with self._lock:
+            start = bisect.bisect_right(self._columns['seq'], seq, 0, self._len)
+            if start < self.thinned:
+                return None
+            if maxpts is not None and self._len - start > maxpts:
+                return None
+            return self.records(range(start, self._len))
+
+    def column(self, name):
+        '''
+        zero-copy numpy view of a column, valid until the buffer is changed
+        '''
+        import numpy as np
+        return np.frombuffer(self._columns[name], dtype=np.float64, count=self._len)
+
+    def columns(self):
+        '''views of all the columns, consistent with each other'''
+        with self._lock:
+            return {name: self.column(name) for name in self.COLUMNS}
+
+    def row(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("telemetry row out of range")
+        return {name: self._columns[name][index] for name in self.COLUMNS}
+
+    def records(self, indices=None):
+        '''list of state dictionaries for the given rows (all by default)'''
+        if indices is None:
+            indices = range(self._len)
+        return [self.row(i) for i in indices]
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self._columns.values())
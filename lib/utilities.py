@@ -1,45 +1,98 @@
 ###############################################################################
 import os
+import functools
 import numpy as np
-import scipy.integrate as integrate
-import scipy.signal as signal
+
+# above this many multiplications the convolution is done with FFTs:
+DIRECT_CONVOLUTION_MAX = 1000000
+
+# boundary modes of smooth_gaussian and the matching np.pad modes:
+PAD_MODES = {'reflect': 'reflect', 'nearest': 'edge'}
+
+
+###############################################################################
+@functools.lru_cache(maxsize=32)
+def gaussian_kernel(sigma, dx):
+    """
+    Gaussian kernel and first derivative of the Gaussian kernel sampled
+    with spacing dx over +-6 sigma, with an odd number of points.
+
+    The kernel sums to one and the derivative kernel gives the slope of a
+    linear signal exactly. Kernels are cached per (sigma, dx) and read only.
+    """
+    half = int(np.ceil(6. * sigma / dx))
+    gx = np.arange(-half, half + 1) * dx
+    kernel = np.exp(-0.5 * (gx / sigma)**2)
+    kernel = kernel / np.sum(kernel)
+    d_kernel = -gx / sigma**2 * kernel
+    d_kernel = d_kernel / np.sum(-gx * d_kernel)
+    kernel.flags.writeable = False
+    d_kernel.flags.writeable = False
+    return kernel, d_kernel
 
 
 ###############################################################################
-def smooth_gaussian(x, y, sigma):
+def _convolve_valid(padded, kernels, method):
+    """
+    Convolve padded with every kernel, keeping the samples not affected by
+    the ends of padded. With FFTs, the transform of padded is shared.
+    """
+    size = len(kernels[0])
+    if method == 'auto':
+        method = 'direct' if len(padded) * size <= DIRECT_CONVOLUTION_MAX else 'fft'
+    if method == 'direct':
+        return [np.convolve(padded, kernel, mode='valid') for kernel in kernels]
+    if method != 'fft':
+        raise ValueError('unknown convolution method ' + str(method))
+    n = len(padded) + size - 1
+    nfft = 1 << (n - 1).bit_length()
+    transform = np.fft.rfft(padded, nfft)
+    return [np.fft.irfft(transform * np.fft.rfft(kernel, nfft), nfft)[size-1:len(padded)]
+            for kernel in kernels]
+
+
+###############################################################################
+def smooth_gaussian(x, y, sigma, mode='reflect', method='auto', derivative=False):
     """
     Takes an array and applies Gaussian smoothing in units of the input
-    x array.
+    x array, which has to be equispaced.
 
     Sigma is the smoothing scale in whatever units x has.
-    Reflective boundaries can be implemented.
+    Mode is the boundary condition: 'reflect' mirrors the signal about the
+    end points, 'nearest' repeats the end values.
+    Method is 'direct', 'fft' or 'auto' to choose by size.
+    With derivative the derivative of the smoothed signal with respect to
+    x is returned as well, computed in the same pass.
     """
+    y = np.asarray(y, dtype=float)
     # get the spacing:
     dx = (np.amax(x)-np.amin(x))/float(len(x)-1)
     # test for legality of sigma:
     if np.abs(6.*sigma) <= dx:
         raise ValueError('smoothing scale (sigma) is smaller than discretization grid')
-    # get the grid:
-    gx = np.arange(-6*sigma, 6*sigma, dx)
-    # define the un-normalized kernel:
-    kernel = np.exp(-0.5*(gx/sigma)**2)
-    # normalize the kernel:
-    kernel = kernel/integrate.simps(kernel, range(len(kernel)))
-    # if the kernel is larger than the signal mirror the signal an appropriate number of times:
-    if len(kernel) > len(y):
-        num_rep = int(np.ceil(len(kernel)/len(y)))
-        # make sure repetitions are even:
-        if num_rep % 2 == 0:
-            num_rep += 1
-        _y = np.tile(y, num_rep)
-    else:
-        _y = y
-    # perform the convolution:
-    _temp = signal.fftconvolve(_y, kernel, mode="same")
-    # get the central part if we have tiled:
-    if len(kernel) > len(y):
-        _temp = _temp[len(y)*(num_rep-1)//2:len(y)*(num_rep-1)//2+len(y)]
-    #
-    return _temp
+    if mode not in PAD_MODES:
+        raise ValueError('unknown boundary mode ' + str(mode))
+    kernel, d_kernel = gaussian_kernel(float(sigma), float(dx))
+    # pad the signal with the boundary condition, np.pad reflects as many
+    # times as needed when the kernel is longer than the signal:
+    half = len(kernel) // 2
+    padded = np.pad(y, half, mode=PAD_MODES[mode])
+    if not derivative:
+        return _convolve_valid(padded, [kernel], method)[0]
+    return tuple(_convolve_valid(padded, [kernel, d_kernel], method))
+
 
 ###############################################################################
+def fire_duration(time, temperature, unload_temperature):
+    """
+    Time spent above unload_temperature, in the units of time, from the
+    first to the last sample above it. Each interval counts by the
+    fraction of its two ends above it (trapezoid rule).
+    """
+    time = np.asarray(time, dtype=float)
+    hot = np.asarray(temperature) > unload_temperature
+    if not np.any(hot):
+        return 0.
+    first, last = np.flatnonzero(hot)[[0, -1]]
+    hot = hot[first:last+1].astype(float)
+    return float(np.sum(0.5 * (hot[1:] + hot[:-1]) * np.diff(time[first:last+1])))
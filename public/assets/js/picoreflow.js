@@ -3,6 +3,7 @@ var state_last = "";
 var graph = [ 'profile', 'live'];
 var points = [];
 var profiles = [];
+var profiles_version = null;
 var time_mode = 0;
 var selected_profile = 0;
 var selected_profile_name = 'monitor.json';
@@ -16,11 +17,71 @@ var currency_type = "USD";
 
 var host = "wss://" + window.location.hostname + ":" + window.location.port;
 
-var ws_status = new WebSocket(host+"/status");
+// last status frame received, sent back on reconnect to only get what was missed
+var status_seq = null;
+var status_epoch = null;
+
+var ws_status = new WebSocket(statusURL());
 var ws_control = new WebSocket(host+"/control");
 var ws_config = new WebSocket(host+"/config");
 var ws_storage = new WebSocket(host+"/storage");
 
+function statusURL()
+{
+    if (status_seq === null) return host+"/status?format=compact";
+    return host+"/status?format=compact&since="+status_seq+"&epoch="+status_epoch;
+}
+
+// compact status format, see docs/api.md
+var compact_fields = {r: ["runtime", 10], T: ["temperature", 10], g: ["target", 10], h: ["heat", 1000], p: ["pid", 1000], tt: ["totaltime", 1], s: ["state", 0],
+                      Ts: ["temperature_smooth", 10], rr: ["ramp_rate", 10], re: ["ramp_error", 10],
+                      e: ["energy", 1000], c: ["cost", 100], ft: ["forecast_time_left", 1], fp: ["forecast_peak", 10]};
+var compact_state = {};
+var compact_runtime = 0;
+
+// smoothed ramp rate computed by the server, in degrees per hour
+function updateRampRate(x)
+{
+    if (x.ramp_rate === undefined || x.ramp_rate === null) { $('#ramp_rate').html(''); return; }
+    var html = (x.ramp_rate >= 0 ? '+' : '') + parseInt(x.ramp_rate) + '&deg;' + temp_scale_display + '/h';
+    if (x.ramp_error !== undefined && x.ramp_error !== null)
+        html += ' (' + (x.ramp_error >= 0 ? '+' : '') + parseInt(x.ramp_error) + ')';
+    $('#ramp_rate').html(html);
+}
+
+function decodeStatus(x)
+{
+    if (x.t === undefined) return x;
+
+    if (x.t == "s")
+    {
+        // only the fields that changed since the previous frame are sent
+        for (var key in x)
+        {
+            if (key == "t") continue;
+            if (key == "q") { compact_state.seq = x.q; continue; }
+            if (key == "r") { compact_runtime = x.r; continue; }
+            if (key == "dr") { compact_runtime += x.dr; continue; }
+            var field = compact_fields[key];
+            if (field === undefined) compact_state[key] = x[key];
+            else compact_state[field[0]] = (field[1] && x[key] !== null) ? x[key] / field[1] : x[key];
+        }
+        compact_state.runtime = compact_runtime / 10;
+        return $.extend({}, compact_state);
+    }
+
+    // backlog and resume frames come as columns
+    var out = { type: (x.t == "b") ? "backlog" : "resume", profile: x.profile, seq: x.seq, epoch: x.epoch, log: [] };
+    var cols = x.cols;
+    var runtime = cols.r0;
+    for (var i=0; i<cols.T.length; i++)
+    {
+        if (i > 0) runtime += cols.dr[i-1];
+        out.log.push({ runtime: runtime/10, temperature: cols.T[i]/10, target: cols.g[i]/10, heat: cols.h[i]/1000, pid: cols.p[i]/1000 });
+    }
+    return out;
+}
+
 if(window.webkitRequestAnimationFrame) window.requestAnimationFrame = window.webkitRequestAnimationFrame;
 
 graph.profile =
@@ -57,6 +118,25 @@ function updateProfile(id)
     graph.plot = $.plot("#graph_container", [ graph.profile, graph.live ] , getOptions());
 }
 
+function profilesRequest()
+{
+    // the server only sends what changed since the version we have
+    return JSON.stringify({ "cmd": "GET", "version": profiles_version });
+}
+
+function applyProfileChanges(changed, removed)
+{
+    profiles = profiles.filter(function(p) {
+        return $.inArray(p.name, removed) === -1;
+    });
+    $.each(changed, function(i, profile) {
+        var names = profiles.map(function(a) {return a.name;});
+        var index = $.inArray(profile.name, names);
+        if (index === -1) profiles.push(profile);
+        else profiles[index] = profile;
+    });
+}
+
 function deleteProfile()
 {
     var profile = { "type": "profile", "data": "", "name": selected_profile_name };
@@ -67,7 +147,7 @@ function deleteProfile()
 
     ws_storage.send(delete_cmd);
 
-    ws_storage.send('GET');
+    ws_storage.send(profilesRequest());
     selected_profile_name = profiles[0].name;
 
     state="IDLE";
@@ -277,7 +357,7 @@ function enterEditMode()
 function leaveEditMode()
 {
     selected_profile_name = $('#form_profile_name').val();
-    ws_storage.send('GET');
+    ws_storage.send(profilesRequest());
     state="IDLE";
     $('#edit').hide();
     $('#profile_selector').show();
@@ -454,7 +534,17 @@ $(document).ready(function()
 
         // Status Socket ////////////////////////////////
 
-        ws_status.onopen = function()
+        function connectStatus()
+        {
+            compact_state = {};
+            compact_runtime = 0;
+            ws_status = new WebSocket(statusURL());
+            ws_status.onopen = onStatusOpen;
+            ws_status.onclose = onStatusClose;
+            ws_status.onmessage = onStatusMessage;
+        }
+
+        function onStatusOpen()
         {
             console.log("Status Socket has been opened");
 
@@ -471,7 +561,7 @@ $(document).ready(function()
             });
         };
 
-        ws_status.onclose = function()
+        function onStatusClose()
         {
             $.bootstrapGrowl("<span class=\"glyphicon glyphicon-exclamation-sign\"></span> <b>ERROR 1:</b><br/>Status Websocket not available", {
             ele: 'body', // which element to append to
@@ -483,16 +573,51 @@ $(document).ready(function()
             allow_dismiss: true,
             stackup_spacing: 10 // spacing between consecutively stacked growls.
           });
-        };
+          // try again, the server sends what was missed in the meantime
+          setTimeout(connectStatus, 5000);
+        }
 
-        ws_status.onmessage = function(e)
+        function onStatusMessage(e)
         {
             console.log("received status data")
             console.log(e.data);
 
-            x = JSON.parse(e.data);
+            x = decodeStatus(JSON.parse(e.data));
+            if (x.seq !== undefined) status_seq = x.seq;
+            if (x.epoch !== undefined) status_epoch = x.epoch;
+
+            if (x.type == "job")
+            {
+                // analysis and reports run on the server after a firing
+                if (x.state != "queued")
+                {
+                    $.bootstrapGrowl("<span class=\"glyphicon glyphicon-exclamation-sign\"></span> " + x.kind + " " + x.state,
+                    {
+                    ele: 'body', // which element to append to
+                    type: x.state == "done" ? 'success' : 'error', // (null, 'info', 'error', 'success')
+                    offset: {from: 'top', amount: 250}, // 'top', or 'bottom'
+                    align: 'center', // ('left', 'right', or 'center')
+                    width: 385, // (integer, or 'auto')
+                    delay: 5000,
+                    allow_dismiss: true,
+                    stackup_spacing: 10 // spacing between consecutively stacked growls.
+                    });
+                }
+                return;
+            }
+
+            if (x.type == "resume")
+            {
+                $.each(x.log, function(i,v) {
+                    graph.live.data.push([v.runtime, v.temperature]);
+                });
+                graph.plot = $.plot("#graph_container", [ graph.profile, graph.live ] , getOptions());
+                return;
+            }
+
             if (x.type == "backlog")
             {
+                graph.live.data = [];
                 if (x.profile)
                 {
                     selected_profile_name = x.profile.name;
@@ -545,9 +670,17 @@ $(document).ready(function()
                     eta = new Date(left * 1000).toISOString().substr(11, 8);
 
                     updateProgress(parseFloat(x.runtime)/parseFloat(x.totaltime)*100);
-                    $('#state').html('<span class="glyphicon glyphicon-time" style="font-size: 22px; font-weight: normal"></span><span style="font-family: Digi; font-size: 40px;">' + eta + '</span>');
+                    var used = '';
+                    if (x.energy !== undefined) used = '<span class="ds-unit" style="font-size: 14px"> ' + x.energy.toFixed(1) + ' kWh ('+ currency_type +': '+ x.cost.toFixed(2) +')</span>';
+                    if (x.forecast_time_left !== undefined && x.forecast_time_left !== null)
+                    {
+                        // the end and peak forecast by the server from the thermal model
+                        var forecast_eta = new Date(x.forecast_time_left * 1000).toISOString().substr(11, 8);
+                        used += '<span class="ds-unit" style="font-size: 14px"> forecast ' + forecast_eta + ', peak ' + parseInt(x.forecast_peak) + '&deg;' + temp_scale_display + '</span>';
+                    }
+                    $('#state').html('<span class="glyphicon glyphicon-time" style="font-size: 22px; font-weight: normal"></span><span style="font-family: Digi; font-size: 40px;">' + eta + '</span>' + used);
                     $('#target_temp').html(parseInt(x.target));
-
+                    updateRampRate(x);
 
                 }
                 else
@@ -555,6 +688,7 @@ $(document).ready(function()
                     $("#nav_start").show();
                     $("#nav_stop").hide();
                     $('#state').html('<p class="ds-text">'+state+'</p>');
+                    $('#ramp_rate').html('');
                 }
 
                 $('#act_temp').html(parseInt(x.temperature));
@@ -570,6 +704,10 @@ $(document).ready(function()
             }
         };
 
+        ws_status.onopen = onStatusOpen;
+        ws_status.onclose = onStatusClose;
+        ws_status.onmessage = onStatusMessage;
+
         // Config Socket /////////////////////////////////
 
         ws_config.onopen = function()
@@ -629,7 +767,7 @@ $(document).ready(function()
 
         ws_storage.onopen = function()
         {
-            ws_storage.send('GET');
+            ws_storage.send(profilesRequest());
         };
 
 
@@ -656,9 +794,31 @@ $(document).ready(function()
                 return;
             }
 
-            //the message is an array of profiles
-            //FIXME: this should be better, maybe a {"profiles": ...} container?
-            profiles = message;
+            if(message.type == "profiles")
+            {
+                if(message.unchanged) return;
+                if(message.profiles)
+                {
+                    profiles = message.profiles;
+                }
+                else if (message.base !== profiles_version)
+                {
+                    // changes to a version we do not have, get them all
+                    profiles_version = null;
+                    ws_storage.send(profilesRequest());
+                    return;
+                }
+                else
+                {
+                    applyProfileChanges(message.changed, message.removed);
+                }
+                profiles_version = message.version;
+            }
+            else
+            {
+                //plain list of profiles
+                profiles = message;
+            }
             //delete old options in select
             $('#e2').find('option').remove().end();
             // check if current selected value is a valid profile name
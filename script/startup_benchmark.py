@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Measure the cost of importing what the apps need to start, and fail when
+a heavy library is imported at startup again or a time budget is exceeded.
+
+    python script/startup_benchmark.py
+    python script/startup_benchmark.py --budget 0.5 --runs 10
+
+Every run imports the modules in a fresh interpreter, the best run is
+reported with the slowest imports from python -X importtime.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# what kiln-controller.py and kiln-monitor.py import before the oven runs
+MODULES = [
+    "config",
+    "lib.oven",
+    "lib.ovenWatcher",
+    "lib.ovenMonitor",
+    "lib.journal",
+    "lib.profileStore",
+    "lib.catalog",
+    "lib.export",
+    "lib.plots",
+    "lib.history",
+    "lib.broadcast",
+    "lib.reportWorker",
+]
+
+# only imported when an analysis runs or by the warm up
+LAZY = ["numpy", "scipy", "matplotlib", "smtplib", "email.mime"]
+
+PROBE = """
+import sys, time, json
+sys.path.insert(0, 'lib')
+t0 = time.perf_counter()
+for module in %r:
+    __import__(module)
+elapsed = time.perf_counter() - t0
+lazy = sorted(name for name in sys.modules if name.split('.')[0] in %r or name in %r)
+print(json.dumps({'elapsed': elapsed, 'lazy': lazy}))
+"""
+
+
+def run_once():
+    code = PROBE % (MODULES, [name for name in LAZY if '.' not in name], LAZY)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=repo_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit("importing the app modules failed")
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.rstrip()))
+    return probe, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=None,
+                        help="fail if the best run takes longer, in seconds")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run_once() for i in range(args.runs)]
+    probe, imports = min(runs, key=lambda run: run[0]['elapsed'])
+    print("startup imports: best %.3f s over %d runs" % (probe['elapsed'], args.runs))
+    print("slowest imports (cumulative):")
+    for cumulative, name in sorted(imports, reverse=True)[:args.top]:
+        print("  %8.1f ms  %s" % (cumulative / 1000., name))
+
+    failed = False
+    if probe['lazy']:
+        print("FAIL: imported at startup: %s" % ", ".join(probe['lazy']))
+        failed = True
+    if args.budget is not None and probe['elapsed'] > args.budget:
+        print("FAIL: %.3f s is over the budget of %.3f s" % (probe['elapsed'], args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
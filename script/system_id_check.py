@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Check that the system identification recovers the thermal model of a
+simulated firing, and fail if it does not.
+
+    python script/system_id_check.py
+
+A schedule is fired headless with known model parameters, on the 2 second
+control cycle, saved as a history record and fitted starting from the
+sim_* parameters of config.py.
+"""
+import os
+import sys
+import json
+import datetime
+import tempfile
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, os.path.join(repo_dir, 'lib'))
+
+import numpy as np
+
+import config
+from oven import Profile, ThermalModel
+from simulation import simulate_profile
+from lib.telemetry import TelemetryBuffer
+import lib.history as history
+import lib.systemId as systemId
+
+TRUE = dict(t_env=25., c_heat=400., c_oven=30000., p_heat=config.element_power, R_o=0.15, R_ho=0.07)
+PROFILE = '{"name": "check", "type": "profile", "data": [[0, 70], [10800, 1000], [21600, 2200], [25200, 2200]]}'
+# relative error allowed on the fitted parameters, ThermalModel.step is not
+# the exact discretization the fit uses:
+TOLERANCE = 0.15
+
+
+def main():
+    trace = simulate_profile(Profile(PROFILE), model=ThermalModel(**TRUE))
+    columns = {name: trace[name] for name in ('runtime', 'temperature', 'target', 'heat', 'pid')}
+    columns['seq'] = np.arange(1., len(trace['runtime']) + 1.)
+    with tempfile.TemporaryDirectory() as path:
+        history.write_record(os.path.join(path, 'check' + history.EXTENSION),
+                             TelemetryBuffer.from_columns(columns, capacity=None),
+                             started=datetime.datetime.now())
+        initial = ThermalModel(c_heat=TRUE['c_heat']).parameters()
+        with open(os.path.join(path, 'model.json'), 'w') as f:
+            f.write(json.dumps(initial))
+        model = systemId.fit_history(path, out_path=os.path.join(path, 'model.json'))
+
+    failed = False
+    for name in systemId.FITTED:
+        error = abs(model[name] / TRUE[name] - 1.)
+        print("%-6s fitted %10.4g  true %10.4g  error %5.1f%%" % (name, model[name], TRUE[name], 100. * error))
+        failed |= error > TOLERANCE
+    print("rms residual %.2f degrees, %.2f s" % (model['fit']['rms'], model['fit']['seconds']))
+    failed |= model['fit']['rms'] > 2.
+    if failed:
+        print("FAIL: the fit did not recover the model")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()